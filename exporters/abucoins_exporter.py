@@ -3,15 +3,22 @@
 import logging
 import time
 import os
-import yaml
 import sys
 import requests
 import json
 import base64
 import hashlib
 import hmac
-from prometheus_client import write_to_textfile, start_http_server
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import write_to_textfile
 from prometheus_client.core import REGISTRY, GaugeMetricFamily, CounterMetricFamily
+from lib.collector import Collector
+from lib.exposition import Exposition, start_http_server
+from lib.http import Session
+from lib.poller import Poller
+from lib.rates import RateTable
+from lib.ratelimit import TokenBucket
+from lib.settings import read_config, load_settings
 
 log = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
@@ -19,11 +26,13 @@ logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
 settings = {}
 
 
-def _settings():
+def _settings(cfg=None):
     global settings
 
+    if cfg is None:
+        cfg = read_config('/etc/abucoins_exporter/abucoins_exporter.yaml')
     settings = {
-        'abucoins_exporter': {
+        'abucoins_exporter': load_settings({
             'prom_folder': '/var/lib/node_exporter',
             'interval': 60,
             'api_key': False,
@@ -31,31 +40,17 @@ def _settings():
             'api_passphrase': False,
             'export': 'text',
             'listen_port': 9299,
+            'cache_folder': '/var/cache/ticker_exporter',
+            'series_ttl': 3600,
+            'series_max_misses': 0,
+            'connect_timeout': 5,
+            'read_timeout': 30,
+            'pool_size': 10,
+            'symbols_ttl': 3600,
+            'rate_limit': 10,
             'url': 'https://api.abucoins.com',
-        },
+        }, cfg.get('abucoins_exporter')),
     }
-    config_file = '/etc/abucoins_exporter/abucoins_exporter.yaml'
-    cfg = {}
-    if os.path.isfile(config_file):
-        with open(config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
-    if cfg.get('abucoins_exporter'):
-        if cfg['abucoins_exporter'].get('prom_folder'):
-            settings['abucoins_exporter']['prom_folder'] = cfg['abucoins_exporter']['prom_folder']
-        if cfg['abucoins_exporter'].get('interval'):
-            settings['abucoins_exporter']['interval'] = cfg['abucoins_exporter']['interval']
-        if cfg['abucoins_exporter'].get('api_key'):
-            settings['abucoins_exporter']['api_key'] = cfg['abucoins_exporter']['api_key']
-        if cfg['abucoins_exporter'].get('api_secret'):
-            settings['abucoins_exporter']['api_secret'] = cfg['abucoins_exporter']['api_secret']
-        if cfg['abucoins_exporter'].get('api_passphrase'):
-            settings['abucoins_exporter']['api_passphrase'] = cfg['abucoins_exporter']['api_passphrase']
-        if cfg['abucoins_exporter'].get('url'):
-            settings['abucoins_exporter']['url'] = cfg['abucoins_exporter']['url']
-        if cfg['abucoins_exporter'].get('export') in ['text', 'http']:
-            settings['abucoins_exporter']['export'] = cfg['abucoins_exporter']['export']
-        if cfg['abucoins_exporter'].get('listen_port'):
-            settings['abucoins_exporter']['listen_port'] = cfg['abucoins_exporter']['listen_port']
 
 
 class AbuCoins(requests.auth.AuthBase):
@@ -86,11 +81,17 @@ class AbuCoins(requests.auth.AuthBase):
         return request
 
 
-class AbucoinsCollector:
-    symbols = []
-    rates = {}
+class AbucoinsCollector(Collector):
+    name = 'abucoins'
+    state = ('rates',)
+    series = ('rates',)
 
     def __init__(self):
+        self.symbols = set()
+        self.symbolsLoaded = 0
+        self.rates = RateTable()
+        self.limiter = TokenBucket(float(settings['abucoins_exporter']['rate_limit']))
+        self.pool = ThreadPoolExecutor(max_workers=int(settings['abucoins_exporter']['pool_size']))
         if (
             settings['abucoins_exporter'].get('api_key')
             and settings['abucoins_exporter'].get('api_secret')
@@ -101,6 +102,11 @@ class AbucoinsCollector:
                 secret_key=settings['abucoins_exporter']['api_secret'],
                 passphrase=settings['abucoins_exporter']['api_passphrase']
             )
+        self.session = Session(
+            connect_timeout=settings['abucoins_exporter']['connect_timeout'],
+            read_timeout=settings['abucoins_exporter']['read_timeout'],
+        ).pool(settings['abucoins_exporter']['url'], settings['abucoins_exporter']['pool_size'])
+        super().__init__(settings['abucoins_exporter'])
 
     def _translate(self, currency):
         r = currency
@@ -116,12 +122,14 @@ class AbucoinsCollector:
 
     def _getSymbols(self):
         """
-        Gets the list of traded symbols
+        Gets the set of traded symbols, once they are older than `symbols_ttl`
         """
+        if time.time() - self.symbolsLoaded < int(settings['abucoins_exporter']['symbols_ttl']):
+            return
         path = '/products'
 
         try:
-            r = requests.get(settings['abucoins_exporter']['url'] + path, verify=True)  # Doesn't need authentication
+            r = self.session.get(settings['abucoins_exporter']['url'] + path, verify=True)  # Doesn't need authentication
         except (
             requests.exceptions.ConnectionError,
             requests.exceptions.ReadTimeout,
@@ -130,38 +138,41 @@ class AbucoinsCollector:
             log.warning(e)
             r = False
         if r and r.status_code == 200:
-            for symbol in r.json():
-                if symbol['id'] not in self.symbols:
-                    self.symbols.append(symbol['id'])
+            self.symbols = {symbol['id'] for symbol in r.json()}
+            self.symbolsLoaded = time.time()
 
         log.debug('Found the following symbols: {}'.format(self.symbols))
 
+    def _getTicker(self, symbol):
+        self.limiter.acquire()
+        path = "/products/{symbol}/ticker".format(symbol=symbol)
+        try:
+            r = self.session.get(settings['abucoins_exporter']['url'] + path, verify=True)
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+            requests.packages.urllib3.exceptions.ReadTimeoutError
+        ) as e:
+            log.warning(e)
+            r = False
+        if r and r.status_code == 200:
+            return r.json()
+
     def _getExchangeRates(self):
         self._getSymbols()
-        for symbol in self.symbols:
-            path = "/products/{symbol}/ticker".format(symbol=symbol)
-            try:
-                r = requests.get(settings['abucoins_exporter']['url'] + path, verify=True)
-            except (
-                requests.exceptions.ConnectionError,
-                requests.exceptions.ReadTimeout,
-                requests.packages.urllib3.exceptions.ReadTimeoutError
-            ) as e:
-                log.warning(e)
-                r = False
-            if r and r.status_code == 200:
-                ticker = r.json()
+        symbols = list(self.symbols)
+        for symbol, ticker in zip(symbols, self.pool.map(self._getTicker, symbols)):
+            if ticker:
                 currencies = symbol.split('-')
-                self.rates.update({
-                    symbol: {
-                        'source_currency': self._translate(currencies[0]),
-                        'target_currency': self._translate(currencies[1]),
-                        'value': float(ticker['price']),
-                    }
-                })
-        log.debug('Found the following ticker rates: {}'.format(self.rates))
-
-    def collect(self):
+                pair = '{}/{}'.format(self._translate(currencies[0]), self._translate(currencies[1]))
+                if self.rates.set(pair, float(ticker['price'])):
+                    self._seen('rates', pair)
+        log.debug('Found {} ticker rates'.format(len(self.rates)))
+
+    def _refresh(self):
+        self._getExchangeRates()
+
+    def _collect(self):
         metrics = {
             'exchange_rate': GaugeMetricFamily(
                 'exchange_rate',
@@ -169,13 +180,12 @@ class AbucoinsCollector:
                 labels=['source_currency', 'target_currency', 'exchange']
             ),
         }
-        self._getExchangeRates()
-        for rate in self.rates:
+        for source_currency, target_currency, value in self.rates.rows():
             metrics['exchange_rate'].add_metric(
-                value=self.rates[rate]['value'],
+                value=value,
                 labels=[
-                    self.rates[rate]['source_currency'],
-                    self.rates[rate]['target_currency'],
+                    source_currency,
+                    target_currency,
                     'abucoins'
                 ]
             )
@@ -185,17 +195,21 @@ class AbucoinsCollector:
 
 
 def _collect_to_text():
+    e = AbucoinsCollector()
     while True:
-        e = AbucoinsCollector()
+        e.refresh()
         write_to_textfile('{0}/abucoins_exporter.prom'.format(settings['abucoins_exporter']['prom_folder']), e)
         time.sleep(int(settings['abucoins_exporter']['interval']))
 
 
 def _collect_to_http():
-    REGISTRY.register(AbucoinsCollector())
-    start_http_server(int(settings['abucoins_exporter']['listen_port']))
-    while True:
-        time.sleep(int(settings['abucoins_exporter']['interval']))
+    e = AbucoinsCollector()
+    REGISTRY.register(e)
+    exposition = Exposition(REGISTRY)
+    start_http_server(int(settings['abucoins_exporter']['listen_port']), exposition)
+    poller = Poller(e.refresh, int(settings['abucoins_exporter']['interval']), exposition.render)
+    poller.start()
+    poller.join()
 
 
 if __name__ == '__main__':
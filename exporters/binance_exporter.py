@@ -3,202 +3,178 @@
 import logging
 import time
 import os
-import yaml
 import sys
-import ccxt
-from prometheus_client import write_to_textfile, start_http_server
-from prometheus_client.core import REGISTRY, GaugeMetricFamily, CounterMetricFamily
+import json
+import threading
+from prometheus_client import write_to_textfile
+from prometheus_client.core import REGISTRY, GaugeMetricFamily
+from lib.ccxt_collector import CcxtCollector
+from lib.exposition import Exposition, start_http_server
+from lib.poller import Poller
+from lib.settings import read_config, load_settings
 
 log = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
 
 settings = {}
 
+# The longest wait, in seconds, before reconnecting a stream that keeps failing
+STREAM_MAX_BACKOFF = 60
 
-def _settings():
+
+def _settings(cfg=None):
     global settings
 
+    if cfg is None:
+        cfg = read_config('/etc/binance_exporter/binance_exporter.yaml')
     settings = {
-        'binance_exporter': {
+        'binance_exporter': load_settings({
             'prom_folder': '/var/lib/node_exporter',
             'interval': 60,
             'api_key': None,
             'api_secret': None,
             'export': 'text',
             'listen_port': 9308,
-        },
+            'markets_ttl': 3600,
+            'cache_folder': '/var/cache/ticker_exporter',
+            'series_ttl': 3600,
+            'series_max_misses': 0,
+            'stream': False,
+            'stream_url': 'wss://stream.binance.com:9443/stream?streams=!miniTicker@arr',
+            'stream_timeout': 60,
+        }, cfg.get('binance_exporter')),
     }
-    config_file = '/etc/binance_exporter/binance_exporter.yaml'
-    cfg = {}
-    if os.path.isfile(config_file):
-        with open(config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
-    if cfg.get('binance_exporter'):
-        if cfg['binance_exporter'].get('prom_folder'):
-            settings['binance_exporter']['prom_folder'] = cfg['binance_exporter']['prom_folder']
-        if cfg['binance_exporter'].get('interval'):
-            settings['binance_exporter']['interval'] = cfg['binance_exporter']['interval']
-        if cfg['binance_exporter'].get('api_key'):
-            settings['binance_exporter']['api_key'] = cfg['binance_exporter']['api_key']
-        if cfg['binance_exporter'].get('api_secret'):
-            settings['binance_exporter']['api_secret'] = cfg['binance_exporter']['api_secret']
-        if cfg['binance_exporter'].get('export') in ['text', 'http']:
-            settings['binance_exporter']['export'] = cfg['binance_exporter']['export']
-        if cfg['binance_exporter'].get('listen_port'):
-            settings['binance_exporter']['listen_port'] = cfg['binance_exporter']['listen_port']
-
-
-class BinanceCollector:
-    rates = {}
-    accounts = {}
-    hasApiCredentials = False
-    markets = None
+
+
+class BinanceCollector(CcxtCollector):
+    """
+    In the `stream` mode, the rates are updated from the mini ticker stream of all the markets, instead of fetching all
+    the tickers at every refresh. The tickers are fetched once after every (re)connection of the stream, to resync,
+    and at every refresh while the stream is down. The updates received are applied by the next refresh.
+    """
+    name = 'binance'
+    stream = None
+    connected = False
+    resync = True
+    eventTime = 0
 
     def __init__(self):
-        self.binance = ccxt.binance({'nonce': ccxt.binance.milliseconds})
-        if (settings['binance_exporter'].get('api_key') and (settings['binance_exporter'].get('api_secret'))):
-            self.binance.apiKey = settings['binance_exporter'].get('api_key')
-            self.binance.secret = settings['binance_exporter'].get('api_secret')
-            self.hasApiCredentials = True
+        self.updates = {}
+        self.lock = threading.Lock()
+        self.streaming = bool(settings['binance_exporter']['stream'])
+        super().__init__(settings['binance_exporter'])
 
-    def _getTickers(self):
+    def _requestPrices(self, exchange):
+        return exchange.publicGetTickerPrice()
+
+    def _parsePrices(self, response, ids):
+        return dict((ids[ticker['symbol']], float(ticker['price'])) for ticker in response if ticker['symbol'] in ids)
+
+    def _setMiniTickers(self, tickers):
+        # Indexed by the refreshes
+        ids = self.ids
+        updates = {}
+        for ticker in tickers:
+            symbol = ids.get(ticker['s'])
+            if symbol:
+                updates[symbol] = float(ticker['c'])
+        with self.lock:
+            self.updates.update(updates)
+            self.eventTime = max([self.eventTime] + [ticker['E'] / 1000 for ticker in tickers])
+
+    def _stream(self):
         """
-        Gets the price ticker.
+        Receives the mini tickers, and reconnects when the stream fails.
         """
-        log.debug('Loading Markets')
-        markets_loaded = False
-        while markets_loaded is False:
-            try:
-                self.binance.loadMarkets(True)
-                markets_loaded = True
-            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                log.warning('{}'.format(e))
-                time.sleep(1)
-
-        if self.binance.has['fetchTickers']:
-            log.debug('Loading Tickers')
-            tickers = self.binance.fetch_tickers()
-        elif self.binance.has['fetchCurrencies']:
-            tickers = {}
-            for symbol in self.binance.symbols:
-                log.debug('Loading Symbol {}'.format(symbol))
-                try:
-                    tickers.update({
-                        symbol: {
-                            'last': self.binance.fetch_ticker(symbol)['last']
-                        }
-                    })
-                except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                    log.warning('{}'.format(e))
-                time.sleep(1)  # don't hit the rate limit
-        else:
-            tickers = {}
-            if not self.markets:
-                log.debug('Fetching markets')
-                self.markets = self.binance.fetch_markets()
-            for market in self.markets:
-                symbol = market.get('symbol')
-                log.debug('Loading Symbol {}'.format(symbol))
-                try:
-                    tickers.update({
-                        symbol: {
-                            'last': self.binance.fetch_ticker(symbol)['last']
-                        }
-                    })
-                except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                    log.warning('{}'.format(e))
-                time.sleep(1)  # don't hit the rate limit
+        import websocket  # websocket-client, only required by the stream mode
 
-        for ticker in tickers:
-            currencies = ticker.split('/')
-            if len(currencies) == 2 and tickers[ticker].get('last'):
-                pair = {
-                    'source_currency': currencies[0],
-                    'target_currency': currencies[1],
-                    'value': float(tickers[ticker]['last']),
-                }
-
-                self.rates.update({
-                    '{}'.format(ticker): pair
-                })
-
-        log.debug('Found the following ticker rates: {}'.format(self.rates))
-
-    def _getAccounts(self):
-        if self.hasApiCredentials:
-            accounts = {}
+        backoff = 1
+        while True:
+            ws = None
             try:
-                accounts = self.binance.fetch_balance()
-                self.accounts = {}
-            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                log.warning('{}'.format(e))
-            if accounts.get('free'):
-                for currency in accounts['free']:
-                    if not self.accounts.get(currency):
-                        self.accounts.update({currency: {}})
-                    self.accounts[currency].update({'free': accounts['free'][currency]})
-            if accounts.get('used'):
-                for currency in accounts['used']:
-                    if not self.accounts.get(currency):
-                        self.accounts.update({currency: {}})
-                    self.accounts[currency].update({'used': accounts['used'][currency]})
-
-        log.debug('Found the following accounts: {}'.format(self.accounts))
-
-    def collect(self):
-        metrics = {
-            'exchange_rate': GaugeMetricFamily(
-                'exchange_rate',
-                'Current exchange rates',
-                labels=['source_currency', 'target_currency', 'exchange']
-            ),
-            'account_balance': GaugeMetricFamily(
-                'account_balance',
-                'Account Balance',
-                labels=['source_currency', 'currency', 'account', 'type']
-            ),
-        }
-        self._getTickers()
-        for rate in self.rates:
-            metrics['exchange_rate'].add_metric(
-                value=self.rates[rate]['value'],
-                labels=[
-                    self.rates[rate]['source_currency'],
-                    self.rates[rate]['target_currency'],
-                    'binance'
-                ]
-            )
+                ws = websocket.create_connection(
+                    settings['binance_exporter']['stream_url'],
+                    timeout=float(settings['binance_exporter']['stream_timeout'])
+                )
+                log.info('Connected to {}'.format(settings['binance_exporter']['stream_url']))
+                with self.lock:
+                    self.resync = True
+                self.connected = True
+                while True:
+                    data = ws.recv()
+                    if not data:
+                        log.warning('The ticker stream was closed')
+                        break
+                    message = json.loads(data)
+                    # The combined streams wrap the events
+                    self._setMiniTickers(message['data'] if isinstance(message, dict) else message)
+                    backoff = 1
+            except (websocket.WebSocketException, OSError, ValueError, KeyError) as e:
+                log.warning('The ticker stream failed: {}'.format(e))
+            except Exception:
+                log.exception('The ticker stream failed')
+            finally:
+                self.connected = False
+                if ws:
+                    ws.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, STREAM_MAX_BACKOFF)
 
-        self._getAccounts()
-        for currency in self.accounts:
-            for account_type in self.accounts[currency]:  # free / used
-                if (self.accounts[currency][account_type] > 0):
-                    metrics['account_balance'].add_metric(
-                        value=(self.accounts[currency][account_type]),
-                        labels=[
-                            currency,
-                            currency,
-                            account_type,
-                            'binance'
-                        ]
-                    )
-
-        for m in metrics.values():
-            yield m
+    def _getTickers(self):
+        if not self.streaming:
+            return super()._getTickers()
+        if not self.markets.load():
+            return
+        # The markets may have been reloaded since the last refresh
+        ids = self._indexMarkets(self.exchange)
+
+        if self.stream is None or not self.stream.is_alive():
+            self.stream = threading.Thread(target=self._stream, daemon=True)
+            self.stream.start()
+        with self.lock:
+            resync, self.resync = self.resync, False
+        if resync or not self.connected:
+            # Polled until the stream is up again
+            super()._getTickers()
+        with self.lock:
+            updates, self.updates = self.updates, {}
+        self._setPrices(updates)
+        if self.connected:
+            # The stream only sends the tickers that changed; the delisted ones are left to expire
+            listed = set(ids.values())
+            for ticker in self.rates:
+                if ticker in listed:
+                    self._seen('rates', ticker)
+
+    def _collect(self):
+        yield from super()._collect()
+        # No lag until the first event
+        if self.stream is not None and self.eventTime:
+            lag = GaugeMetricFamily(
+                'exchange_feed_lag_seconds',
+                'Seconds since the time of the last event received from the ticker stream',
+                labels=['exchange']
+            )
+            lag.add_metric(value=time.time() - self.eventTime, labels=[self.name])
+            yield lag
 
 
 def _collect_to_text():
     e = BinanceCollector()
     while True:
+        e.refresh()
         write_to_textfile('{0}/binance_exporter.prom'.format(settings['binance_exporter']['prom_folder']), e)
         time.sleep(int(settings['binance_exporter']['interval']))
 
 
 def _collect_to_http():
-    REGISTRY.register(BinanceCollector())
-    start_http_server(int(settings['binance_exporter']['listen_port']))
-    while True:
-        time.sleep(int(settings['binance_exporter']['interval']))
+    e = BinanceCollector()
+    REGISTRY.register(e)
+    exposition = Exposition(REGISTRY)
+    start_http_server(int(settings['binance_exporter']['listen_port']), exposition)
+    poller = Poller(e.refresh, int(settings['binance_exporter']['interval']), exposition.render)
+    poller.start()
+    poller.join()
 
 
 if __name__ == '__main__':
@@ -3,11 +3,13 @@
 import logging
 import time
 import os
-import yaml
 import sys
-import ccxt
-from prometheus_client import write_to_textfile, start_http_server
-from prometheus_client.core import REGISTRY, GaugeMetricFamily, CounterMetricFamily
+from prometheus_client import write_to_textfile
+from prometheus_client.core import REGISTRY
+from lib.ccxt_collector import CcxtCollector
+from lib.exposition import Exposition, start_http_server
+from lib.poller import Poller
+from lib.settings import read_config, load_settings
 
 log = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
@@ -15,210 +17,52 @@ logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
 settings = {}
 
 
-def _settings():
+def _settings(cfg=None):
     global settings
 
+    if cfg is None:
+        cfg = read_config('/etc/cex_exporter/cex_exporter.yaml')
     settings = {
-        'cex_exporter': {
+        'cex_exporter': load_settings({
             'prom_folder': '/var/lib/node_exporter',
             'interval': 60,
             'api_key': None,
             'api_secret': None,
             'export': 'text',
             'listen_port': 9311,
+            'markets_ttl': 3600,
+            'cache_folder': '/var/cache/ticker_exporter',
+            'series_ttl': 3600,
+            'series_max_misses': 0,
             'uid': None,
-        },
+        }, cfg.get('cex_exporter')),
     }
-    config_file = '/etc/cex_exporter/cex_exporter.yaml'
-    cfg = {}
-    if os.path.isfile(config_file):
-        with open(config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
-    if cfg.get('cex_exporter'):
-        if cfg['cex_exporter'].get('prom_folder'):
-            settings['cex_exporter']['prom_folder'] = cfg['cex_exporter']['prom_folder']
-        if cfg['cex_exporter'].get('interval'):
-            settings['cex_exporter']['interval'] = cfg['cex_exporter']['interval']
-        if cfg['cex_exporter'].get('api_key'):
-            settings['cex_exporter']['api_key'] = cfg['cex_exporter']['api_key']
-        if cfg['cex_exporter'].get('api_secret'):
-            settings['cex_exporter']['api_secret'] = cfg['cex_exporter']['api_secret']
-        if cfg['cex_exporter'].get('uid'):
-            settings['cex_exporter']['uid'] = cfg['cex_exporter']['uid']
-        if cfg['cex_exporter'].get('export') in ['text', 'http']:
-            settings['cex_exporter']['export'] = cfg['cex_exporter']['export']
-        if cfg['cex_exporter'].get('listen_port'):
-            settings['cex_exporter']['listen_port'] = cfg['cex_exporter']['listen_port']
 
 
-class CexCollector:
-    rates = {}
-    accounts = {}
-    hasApiCredentials = False
-    markets = None
+class CexCollector(CcxtCollector):
+    name = 'cex'
+    disableAccountsOnError = True
 
     def __init__(self):
-        self.cex = ccxt.cex({'nonce': ccxt.cex.milliseconds})
-        if (
-            settings['cex_exporter'].get('api_key')
-            and settings['cex_exporter'].get('api_secret')
-        ):
-            self.cex.apiKey = settings['cex_exporter'].get('api_key')
-            self.cex.secret = settings['cex_exporter'].get('api_secret')
-            self.hasApiCredentials = True
-
-        if settings['cex_exporter'].get('uid'):
-            self.cex.uid = settings['cex_exporter'].get('uid')
-            self.hasApiCredentials = True
-
-    def _getTickers(self):
-        """
-        Gets the price ticker.
-        """
-        log.debug('Loading Markets')
-        markets_loaded = False
-        while markets_loaded is False:
-            try:
-                self.cex.loadMarkets(True)
-                markets_loaded = True
-            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                log.warning('{}'.format(e))
-                time.sleep(1)
-
-        tickers = {}
-        if self.cex.has['fetchTickers']:
-            log.debug('Loading Tickers')
-            try:
-                tickers = self.cex.fetch_tickers()
-            except (
-                ccxt.ExchangeNotAvailable,
-                ccxt.RequestTimeout
-            ) as e:
-                log.warning('{}'.format(e))
-        elif self.cex.has['fetchCurrencies']:
-            for symbol in self.cex.symbols:
-                log.debug('Loading Symbol {}'.format(symbol))
-                try:
-                    tickers.update({
-                        symbol: {
-                            'last': self.cex.fetch_ticker(symbol)['last']
-                        }
-                    })
-                except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                    log.warning('{}'.format(e))
-                time.sleep(1)  # don't hit the rate limit
-        else:
-            if not self.markets:
-                log.debug('Fetching markets')
-                self.markets = self.cex.fetch_markets()
-            for market in self.markets:
-                symbol = market.get('symbol')
-                log.debug('Loading Symbol {}'.format(symbol))
-                try:
-                    tickers.update({
-                        symbol: {
-                            'last': self.cex.fetch_ticker(symbol)['last']
-                        }
-                    })
-                except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                    log.warning('{}'.format(e))
-                time.sleep(1)  # don't hit the rate limit
-
-        for ticker in tickers:
-            currencies = ticker.split('/')
-            if len(currencies) == 2 and tickers[ticker].get('last'):
-                pair = {
-                    'source_currency': currencies[0],
-                    'target_currency': currencies[1],
-                    'value': float(tickers[ticker]['last']),
-                }
-
-                self.rates.update({
-                    '{}'.format(ticker): pair
-                })
-
-        log.debug('Found the following ticker rates: {}'.format(self.rates))
-
-    def _getAccounts(self):
-        if self.hasApiCredentials:
-            accounts = {}
-            try:
-                accounts = self.cex.fetch_balance()
-                self.accounts = {}
-            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
-                log.warning('{}'.format(e))
-            except (ccxt.ExchangeError) as e:
-                self.hasApiCredentials = False
-                log.warning('Cannot access the API with the credentials provided. Disabling account metrics.')
-                log.warning('{}'.format(e))
-
-            if accounts.get('free'):
-                for currency in accounts['free']:
-                    if not self.accounts.get(currency):
-                        self.accounts.update({currency: {}})
-                    self.accounts[currency].update({'free': accounts['free'][currency]})
-            if accounts.get('used'):
-                for currency in accounts['used']:
-                    if not self.accounts.get(currency):
-                        self.accounts.update({currency: {}})
-                    self.accounts[currency].update({'used': accounts['used'][currency]})
-
-        log.debug('Found the following accounts: {}'.format(self.accounts))
-
-    def collect(self):
-        metrics = {
-            'exchange_rate': GaugeMetricFamily(
-                'exchange_rate',
-                'Current exchange rates',
-                labels=['source_currency', 'target_currency', 'exchange']
-            ),
-            'account_balance': GaugeMetricFamily(
-                'account_balance',
-                'Account Balance',
-                labels=['source_currency', 'currency', 'account', 'type']
-            ),
-        }
-        self._getTickers()
-        for rate in self.rates:
-            metrics['exchange_rate'].add_metric(
-                value=self.rates[rate]['value'],
-                labels=[
-                    self.rates[rate]['source_currency'],
-                    self.rates[rate]['target_currency'],
-                    'cex'
-                ]
-            )
-
-        self._getAccounts()
-        for currency in self.accounts:
-            for account_type in self.accounts[currency]:  # free / used
-                if (self.accounts[currency][account_type] > 0):
-                    metrics['account_balance'].add_metric(
-                        value=(self.accounts[currency][account_type]),
-                        labels=[
-                            currency,
-                            currency,
-                            account_type,
-                            'cex'
-                        ]
-                    )
-
-        for m in metrics.values():
-            yield m
+        super().__init__(settings['cex_exporter'])
 
 
 def _collect_to_text():
     e = CexCollector()
     while True:
+        e.refresh()
         write_to_textfile('{0}/cex_exporter.prom'.format(settings['cex_exporter']['prom_folder']), e)
         time.sleep(int(settings['cex_exporter']['interval']))
 
 
 def _collect_to_http():
-    REGISTRY.register(CexCollector())
-    start_http_server(int(settings['cex_exporter']['listen_port']))
-    while True:
-        time.sleep(int(settings['cex_exporter']['interval']))
+    e = CexCollector()
+    REGISTRY.register(e)
+    exposition = Exposition(REGISTRY)
+    start_http_server(int(settings['cex_exporter']['listen_port']), exposition)
+    poller = Poller(e.refresh, int(settings['cex_exporter']['interval']), exposition.render)
+    poller.start()
+    poller.join()
 
 
 if __name__ == '__main__':
@@ -3,126 +3,547 @@
 import logging
 import time
 import os
-import yaml
 import sys
 import requests
 import json
-from prometheus_client import write_to_textfile, start_http_server
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import write_to_textfile
 from prometheus_client.core import REGISTRY, GaugeMetricFamily, CounterMetricFamily
+from lib import cache
+from lib.collector import Collector
+from lib.exposition import Exposition, start_http_server
+from lib.http import Session
+from lib.poller import Poller
+from lib.ratelimit import TokenBucket
+from lib.settings import read_config, load_settings
 
 log = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
 
 settings = {}
 
+# The maximum number of addresses accepted by the balancemulti call
+BALANCEMULTI_SIZE = 20
+# The maximum number of token transfers listed by one tokentx call
+TOKENTX_SIZE = 1000
+# Function selectors of ERC-20 balanceOf(address) and Multicall3 aggregate3((address,bool,bytes)[])
+SELECTOR_BALANCE_OF = '70a08231'
+SELECTOR_AGGREGATE3 = '82ad56cb'
 
-def _settings():
+
+def _settings(cfg=None):
     global settings
 
+    if cfg is None:
+        cfg = read_config('/etc/etherscan_exporter/etherscan_exporter.yaml')
     settings = {
-        'etherscan_exporter': {
+        'etherscan_exporter': load_settings({
             'prom_folder': '/var/lib/node_exporter',
             'interval': 60,
             'api_key': False,
             'export': 'text',
             'listen_port': 9301,
+            'cache_folder': '/var/cache/ticker_exporter',
+            'series_ttl': 3600,
+            'series_max_misses': 0,
+            'connect_timeout': 5,
+            'read_timeout': 30,
+            'pool_size': 10,
+            'rate_limit': 5,
+            'max_retries': 3,
+            'change_detection': False,
+            'confirmations': 12,
+            'discover_tokens': False,
+            'multicall': False,
+            'multicall_address': '0xcA11bde05977b3631167028862bE2a173976CA11',
+            'multicall_size': 16,
+            'rpc_url': False,
+            'rpc_batch_size': 1000,
+            'backend': 'etherscan',
             'url': 'https://api.etherscan.io/api',
             'addresses': [],
             'tokens': [],
-        },
+        }, cfg.get('etherscan_exporter')),
     }
-    config_file = '/etc/etherscan_exporter/etherscan_exporter.yaml'
-    cfg = {}
-    if os.path.isfile(config_file):
-        with open(config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
-    if cfg.get('etherscan_exporter'):
-        if cfg['etherscan_exporter'].get('prom_folder'):
-            settings['etherscan_exporter']['prom_folder'] = cfg['etherscan_exporter']['prom_folder']
-        if cfg['etherscan_exporter'].get('interval'):
-            settings['etherscan_exporter']['interval'] = cfg['etherscan_exporter']['interval']
-        if cfg['etherscan_exporter'].get('api_key'):
-            settings['etherscan_exporter']['api_key'] = cfg['etherscan_exporter']['api_key']
-        if cfg['etherscan_exporter'].get('url'):
-            settings['etherscan_exporter']['url'] = cfg['etherscan_exporter']['url']
-        if cfg['etherscan_exporter'].get('export') in ['text', 'http']:
-            settings['etherscan_exporter']['export'] = cfg['etherscan_exporter']['export']
-        if cfg['etherscan_exporter'].get('listen_port'):
-            settings['etherscan_exporter']['listen_port'] = cfg['etherscan_exporter']['listen_port']
-        if cfg['etherscan_exporter'].get('addresses'):
-            settings['etherscan_exporter']['addresses'] = cfg['etherscan_exporter']['addresses']
-        if cfg['etherscan_exporter'].get('tokens'):
-            settings['etherscan_exporter']['tokens'] = cfg['etherscan_exporter']['tokens']
-
-
-class EtherscanCollector:
-    accounts = {}
-    tokens = {}
-
-    def _get_tokens(self):
-        # Ensure that we don't get blocked
-        time.sleep(1)
-        for account in self.accounts:
-            for token in settings['etherscan_exporter']['tokens']:
-                request_data = {
-                    'module': 'account',
-                    'action': 'tokenbalance',
-                    'contractaddress': token['contract'],
-                    'address': account,
-                    'tag': 'latest',
-                    'apikey': settings['etherscan_exporter']['api_key'],
+
+
+def _word(value):
+    return '{:064x}'.format(value)
+
+
+def _encode_multicall(calls):
+    """
+    ABI encodes a Multicall3 `aggregate3` call, from a list of (target address, hex call data). Every call may fail
+    without failing the others.
+    """
+    heads = []
+    tails = []
+    offset = 32 * len(calls)
+    for target, data in calls:
+        call = _word(int(target, 16)) + _word(1) + _word(96) + _word(len(data) // 2) + data + '0' * (-len(data) % 64)
+        heads.append(_word(offset))
+        tails.append(call)
+        offset += len(call) // 2
+    return '0x' + SELECTOR_AGGREGATE3 + _word(32) + _word(len(calls)) + ''.join(heads) + ''.join(tails)
+
+
+def _decode_multicall(data):
+    """
+    Decodes the result of a Multicall3 `aggregate3` call into a list of (success, returned bytes).
+    """
+    data = bytes.fromhex(data[2:] if data.startswith('0x') else data)
+
+    def word(offset):
+        return int.from_bytes(data[offset:offset + 32], 'big')
+
+    array = word(0) + 32
+    results = []
+    for i in range(word(array - 32)):
+        result = array + word(array + 32 * i)
+        returned = result + word(result + 32)
+        results.append((bool(word(result)), data[returned + 32:returned + 32 + word(returned)]))
+    return results
+
+
+def _quantity(result):
+    """
+    Returns the integer encoded in the hex `result` of a JSON-RPC call, or None.
+    """
+    try:
+        return int(result, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def _token_key(account, token):
+    """
+    Returns the key of the balance of `token` held by `account`: tokens are told apart by their contract, as several
+    contracts may use the same symbol.
+    """
+    return '{}-{}'.format(account, token['contract'].lower())
+
+
+class EtherscanCollector(Collector):
+    name = 'etherscan'
+    state = ('accounts', 'tokens', 'synced', 'holdings', 'scanned')
+    series = ('accounts', 'tokens')
+
+    def __init__(self):
+        self.accounts = {}
+        self.tokens = {}
+        self.synced = {}
+        self.holdings = {}
+        self.scanned = {}
+        self.configured = {token['contract'].lower(): token for token in settings['etherscan_exporter']['tokens']}
+        self.metadataFile = self._cacheFile(settings['etherscan_exporter']['cache_folder'], 'tokens')
+        self.metadata = (cache.load(self.metadataFile) if self.metadataFile else None) or {}
+        self.limiter = TokenBucket(float(settings['etherscan_exporter']['rate_limit']))
+        self.pool = ThreadPoolExecutor(max_workers=int(settings['etherscan_exporter']['pool_size']))
+        self.session = Session(
+            connect_timeout=settings['etherscan_exporter']['connect_timeout'],
+            read_timeout=settings['etherscan_exporter']['read_timeout'],
+        ).pool(settings['etherscan_exporter']['url'], settings['etherscan_exporter']['pool_size'])
+        if settings['etherscan_exporter']['rpc_url']:
+            self.session.pool(settings['etherscan_exporter']['rpc_url'], settings['etherscan_exporter']['pool_size'])
+        super().__init__(settings['etherscan_exporter'])
+
+    def _loadState(self, attr, value):
+        """
+        Snapshots used to key the tokens by symbol: keys them by contract, and drops the blocks they were synced at.
+        """
+        if attr == 'tokens':
+            value = dict((_token_key(token['account'], {'contract': token['contract_address']}), token)
+                         for token in value.values())
+        elif attr == 'synced':
+            value = dict((key, block) for key, block in value.items() if '-' not in key or key in self.tokens)
+        super()._loadState(attr, value)
+
+    def _query(self, request_data):
+        """
+        Queries the etherscan API, within the rate limit of the API key. Retries if the limit is reached anyway.
+        """
+        for attempt in range(int(settings['etherscan_exporter']['max_retries']) + 1):
+            self.limiter.acquire()
+            try:
+                r = self.session.get(settings['etherscan_exporter']['url'], params=request_data).json()
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ReadTimeout,
+                requests.packages.urllib3.exceptions.ReadTimeoutError,
+                ValueError
+            ) as e:
+                log.warning(e)
+                return {}
+            if 'rate limit' not in str(r.get('result')):
+                return r
+            log.debug('Rate limit reached, retrying: {}'.format(r.get('result')))
+            time.sleep(attempt + 1)
+        log.warning('Rate limit reached, giving up: {}'.format(request_data))
+        return {}
+
+    def _rpc_batch(self, calls):
+        """
+        Sends the (method, params) calls to the `rpc_url` node in one JSON-RPC batch request. Returns their results,
+        None for the calls that failed.
+        """
+        results = [None] * len(calls)
+        try:
+            r = self.session.post(settings['etherscan_exporter']['rpc_url'], json=[
+                {'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params}
+                for i, (method, params) in enumerate(calls)
+            ]).json()
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+            requests.packages.urllib3.exceptions.ReadTimeoutError,
+            ValueError
+        ) as e:
+            log.warning(e)
+            return results
+        if not isinstance(r, list):
+            log.warning('JSON-RPC batch failed: {}'.format(r.get('error') if isinstance(r, dict) else r))
+            return results
+        for response in r:
+            # Parse errors have a null id, which matches no call
+            if not isinstance(response, dict) or not isinstance(response.get('id'), int):
+                log.debug('Unexpected JSON-RPC response: {}'.format(response))
+            elif response['id'] not in range(len(calls)):
+                log.debug('Unexpected JSON-RPC response id: {}'.format(response['id']))
+            elif response.get('error'):
+                log.debug('{} failed: {}'.format(calls[response['id']], response['error']))
+            else:
+                results[response['id']] = response.get('result')
+        return results
+
+    def _eth_call(self, to, data):
+        """
+        Runs `eth_call` on the `rpc_url` node if there is one, through the etherscan proxy otherwise. Returns the hex
+        result, or None.
+        """
+        if settings['etherscan_exporter']['rpc_url']:
+            result = self._rpc_batch([('eth_call', [{'to': to, 'data': data}, 'latest'])])[0]
+        else:
+            r = self._query({
+                'module': 'proxy',
+                'action': 'eth_call',
+                'to': to,
+                'data': data,
+                'tag': 'latest',
+                'apikey': settings['etherscan_exporter']['api_key'],
+            })
+            result = r.get('result')
+        if isinstance(result, str) and result.startswith('0x'):
+            return result
+        log.warning('eth_call to {} failed: {}'.format(to, result))
+
+    def _get_token_balances_multicall(self, pairs):
+        """
+        Fetches the balances of the (account, token) pairs with a single multicall of balanceOf.
+        """
+        calls = [(token['contract'], SELECTOR_BALANCE_OF + _word(int(account, 16))) for account, token in pairs]
+        result = self._eth_call(settings['etherscan_exporter']['multicall_address'], _encode_multicall(calls))
+        results = _decode_multicall(result) if result else []
+        if len(results) != len(pairs):
+            return [None] * len(pairs)
+        return [int.from_bytes(data[:32], 'big') if success and len(data) >= 32 else None for success, data in results]
+
+    def _get_token_balances(self, pairs):
+        if settings['etherscan_exporter']['multicall']:
+            size = int(settings['etherscan_exporter']['multicall_size'])
+            chunks = [pairs[i:i + size] for i in range(0, len(pairs), size)]
+            balances = self.pool.map(self._get_token_balances_multicall, chunks)
+            return [balance for chunk in balances for balance in chunk]
+        return self.pool.map(self._get_token_balance, [pair[0] for pair in pairs], [pair[1] for pair in pairs])
+
+    def _get_token_balance(self, account, token):
+        request_data = {
+            'module': 'account',
+            'action': 'tokenbalance',
+            'contractaddress': token['contract'],
+            'address': account,
+            'tag': 'latest',
+            'apikey': settings['etherscan_exporter']['api_key'],
+        }
+        r = self._query(request_data)
+        if r.get('status') == '1' and str(r.get('result')).isdigit():
+            return int(r['result'])
+
+    def _get_block(self):
+        """
+        Returns the number of the latest block, or None if it can't be fetched.
+        """
+        r = self._query({
+            'module': 'proxy',
+            'action': 'eth_blockNumber',
+            'apikey': settings['etherscan_exporter']['api_key'],
+        })
+        try:
+            return int(r['result'], 16)
+        except (KeyError, TypeError, ValueError):
+            log.warning('Could not get the latest block: {}'.format(r.get('result')))
+
+    def _get_transfers(self, account, start_block, end_block):
+        """
+        Returns the (lower case) contract addresses of the tokens transferred from or to `account` between the two
+        blocks, or None if they can't be all listed.
+        """
+        request_data = {
+            'module': 'account',
+            'action': 'tokentx',
+            'address': account,
+            'startblock': start_block,
+            'endblock': end_block,
+            'page': 1,
+            'offset': TOKENTX_SIZE,
+            'sort': 'asc',
+            'apikey': settings['etherscan_exporter']['api_key'],
+        }
+        r = self._query(request_data)
+        if not isinstance(r.get('result'), list) or len(r['result']) >= TOKENTX_SIZE:
+            return None
+        return set(transfer['contractAddress'].lower() for transfer in r['result'])
+
+    def _scan_transfers(self, account, block=None):
+        """
+        Lists the tokens transferred from or to `account` since its last scan, up to `block` (or the latest one).
+        Returns their metadata by (lower case) contract address and the last block scanned, or (None, None) if they
+        can't be listed.
+        """
+        start = 0
+        if account in self.scanned:
+            # The transfers of the last blocks may not have been indexed yet at the last scan
+            start = max(self.scanned[account] + 1 - int(settings['etherscan_exporter']['confirmations']), 0)
+        scanned = block
+        found = {}
+        if block is not None and start > block:
+            return found, scanned
+        while True:
+            request_data = {
+                'module': 'account',
+                'action': 'tokentx',
+                'address': account,
+                'startblock': start,
+                'page': 1,
+                'offset': TOKENTX_SIZE,
+                'sort': 'asc',
+                'apikey': settings['etherscan_exporter']['api_key'],
+            }
+            if block is not None:
+                request_data['endblock'] = block
+            r = self._query(request_data)
+            if not isinstance(r.get('result'), list):
+                return None, None
+            for transfer in r['result']:
+                metadata = {
+                    'name': transfer['tokenName'],
+                    'short': transfer['tokenSymbol'] or transfer['contractAddress'],
                 }
-                decimals = 18
-                if token.get('decimals', -1) >= 0:
-                    decimals = int(token['decimals'])
-                log.debug('{} decimals for {}'.format(decimals, token['short']))
-                try:
-                    r = requests.get(settings['etherscan_exporter']['url'], params=request_data).json()
-                except (
-                    requests.exceptions.ConnectionError,
-                    requests.exceptions.ReadTimeout,
-                    requests.packages.urllib3.exceptions.ReadTimeoutError
-                ) as e:
-                    log.warning(e)
-                    r = {}
-                if r.get('result') and int(r['result']) > 0:
-                    self.tokens.update({
-                        '{}-{}'.format(account, token['short']): {
-                            'account': account,
-                            'name': token['name'],
-                            'name_short': token['short'],
-                            'contract_address': token['contract'],
-                            'value': int(r['result']) / (10**decimals) if decimals > 0 else int(r['result'])
-                        }
-                    })
+                if str(transfer['tokenDecimal']).isdigit():
+                    metadata['decimals'] = int(transfer['tokenDecimal'])
+                found[transfer['contractAddress'].lower()] = metadata
+                scanned = max(scanned or 0, int(transfer['blockNumber']))
+            if len(r['result']) < TOKENTX_SIZE:
+                return found, scanned
+            # The next page starts with the last block listed, which may have more transfers
+            start = max(start + 1, int(r['result'][-1]['blockNumber']))
+
+    def _discover_tokens(self, accounts, block=None):
+        """
+        Adds the tokens transferred from or to the `accounts` since their last scan to their holdings, and their
+        metadata to the metadata cache. Returns the block each account was scanned from (exclusive), and the contracts
+        of the tokens transferred since, by account.
+        """
+        discovered = 0
+        transfers = {}
+        scans = self.pool.map(self._scan_transfers, accounts, [block] * len(accounts))
+        for account, (found, scanned) in zip(accounts, scans):
+            if found is None:
+                log.warning('Could not discover the tokens of {}'.format(account))
+                continue
+            transfers[account] = (self.scanned.get(account, -1), set(found))
+            holdings = self.holdings.setdefault(account, [])
+            for contract in found:
+                if contract not in holdings:
+                    holdings.append(contract)
+                if contract not in self.metadata:
+                    self.metadata[contract] = found[contract]
+                    discovered += 1
+            if scanned is not None:
+                self.scanned[account] = scanned
+        if discovered and self.metadataFile:
+            cache.save(self.metadataFile, self.metadata)
+        log.debug('Holdings: {}'.format(self.holdings))
+        return transfers
+
+    def _account_tokens(self, account):
+        """
+        Returns the tokens to fetch for `account`: the configured ones or, if the tokens are discovered, the ones it
+        holds. The configured tokens override the discovered metadata.
+        """
+        if not settings['etherscan_exporter']['discover_tokens']:
+            return settings['etherscan_exporter']['tokens']
+        tokens = []
+        for contract in self.holdings.get(account, []):
+            token = self.configured.get(contract)
+            if token is None:
+                token = dict(self.metadata.get(contract, {'name': contract, 'short': contract}), contract=contract)
+            tokens.append(token)
+        return tokens
+
+    def _get_stale_tokens(self, account, block, transfers=None):
+        """
+        Returns the tokens of `account` that may have changed since their balance was last fetched. The `transfers`
+        found by the discovery of the tokens, if any, are used instead of listing them again.
+        """
+        tokens = self._account_tokens(account)
+        if block is None or not tokens:
+            return tokens
+        synced = [self.synced.get(_token_key(account, token), -1) for token in tokens]
+        # Never fetched
+        stale = [token for token, since in zip(tokens, synced) if since < 0]
+        since = min([since for since in synced if since >= 0] or [block])
+        if since >= block:
+            return stale
+        if transfers is not None:
+            scanned, contracts = transfers
+            # The transfers before the scan are not listed
+            return stale + [
+                token for token, since in zip(tokens, synced)
+                if since >= 0 and (since < scanned or token['contract'].lower() in contracts)
+            ]
+        # The transfers of the last blocks may not have been indexed yet at the last refresh
+        start = max(since + 1 - int(settings['etherscan_exporter']['confirmations']), 0)
+        contracts = self._get_transfers(account, start, block)
+        if contracts is None:
+            return tokens
+        return stale + [
+            token for token, since in zip(tokens, synced) if since >= 0 and token['contract'].lower() in contracts
+        ]
+
+    def _get_tokens(self, block=None):
+        accounts = list(self.accounts)
+        transfers = {}
+        if settings['etherscan_exporter']['discover_tokens']:
+            transfers = self._discover_tokens(accounts, block)
+        stales = self.pool.map(
+            self._get_stale_tokens, accounts, [block] * len(accounts), [transfers.get(account) for account in accounts]
+        )
+        pairs = []
+        for account, stale in zip(accounts, stales):
+            for token in self._account_tokens(account):
+                key = _token_key(account, token)
+                if token in stale:
+                    pairs.append((account, token))
+                else:
+                    # Not changed since the last fetch
+                    self.synced[key] = block
+                    if key in self.tokens:
+                        self._seen('tokens', key)
+        log.debug('Fetching {} token balances'.format(len(pairs)))
+        self._set_tokens(pairs, self._get_token_balances(pairs), block)
+
+    def _set_tokens(self, pairs, balances, block=None):
+        """
+        Updates the tokens with the balances of the (account, token) pairs. None is a balance that couldn't be fetched.
+        """
+        for (account, token), balance in zip(pairs, balances):
+            key = _token_key(account, token)
+            decimals = 18
+            if token.get('decimals', -1) >= 0:
+                decimals = int(token['decimals'])
+            log.debug('{} decimals for {}'.format(decimals, token['short']))
+            if balance is None:
+                continue
+            if block is not None:
+                self.synced[key] = block
+            if balance:
+                self.tokens.update({
+                    key: {
+                        'account': account,
+                        'name': token['name'],
+                        'name_short': token['short'],
+                        'contract_address': token['contract'],
+                        'value': balance / (10**decimals) if decimals > 0 else balance
+                    }
+                })
+                self._seen('tokens', key)
+            else:
+                self.tokens.pop(key, None)
+                if token['contract'].lower() in self.holdings.get(account, []):
+                    # Not held anymore, until the next transfer
+                    self.holdings[account].remove(token['contract'].lower())
         log.debug('Tokens: {}'.format(self.tokens))
 
-    def _get_balances(self):
+    def _get_balance_chunk(self, addresses):
         request_data = {
             'module': 'account',
             'action': 'balancemulti',
-            'address': ','.join(settings['etherscan_exporter']['addresses']),
+            'address': ','.join(addresses),
             'tag': 'latest',
             'apikey': settings['etherscan_exporter']['api_key'],
         }
         log.debug('Request data: {}'.format(request_data))
-        try:
-            r = requests.get(settings['etherscan_exporter']['url'], params=request_data).json()
-        except (
-            requests.exceptions.ConnectionError,
-            requests.exceptions.ReadTimeout,
-            requests.packages.urllib3.exceptions.ReadTimeoutError
-        ) as e:
-            log.warning(e)
-            r = {}
+        r = self._query(request_data)
         if r.get('message') == 'OK' and r.get('result'):
-            for result in r.get('result'):
+            return r['result']
+        log.warning('Could not get the balances for {}: {}'.format(addresses, r.get('result')))
+        return []
+
+    def _get_balances(self, block=None):
+        """
+        etherscan accepts at most 20 addresses per balancemulti call, so the addresses are split in chunks that are
+        fetched in parallel. A failed chunk keeps the previous balances of its addresses.
+        """
+        addresses = []
+        for address in settings['etherscan_exporter']['addresses']:
+            if block is not None and self.synced.get(address, -1) >= block and address in self.accounts:
+                self._seen('accounts', address)
+            else:
+                addresses.append(address)
+        chunks = [addresses[i:i + BALANCEMULTI_SIZE] for i in range(0, len(addresses), BALANCEMULTI_SIZE)]
+        for results in self.pool.map(self._get_balance_chunk, chunks):
+            for result in results:
                 self.accounts.update({
                     result['account']: float(result['balance'])/(1000000000000000000)
                 })
+                self._seen('accounts', result['account'])
+                if block is not None:
+                    self.synced[result['account']] = block
+        log.debug('Accounts: {}'.format(self.accounts))
+
+    def _refresh_rpc(self):
+        """
+        Fetches all the balances from the `rpc_url` node, with JSON-RPC batch requests of eth_getBalance and eth_call.
+        """
+        addresses = settings['etherscan_exporter']['addresses']
+        if settings['etherscan_exporter']['discover_tokens']:
+            self._discover_tokens(addresses)
+        pairs = [(account, token) for account in addresses for token in self._account_tokens(account)]
+        calls = [('eth_getBalance', [address, 'latest']) for address in addresses]
+        for account, token in pairs:
+            data = '0x' + SELECTOR_BALANCE_OF + _word(int(account, 16))
+            calls.append(('eth_call', [{'to': token['contract'], 'data': data}, 'latest']))
+        size = int(settings['etherscan_exporter']['rpc_batch_size'])
+        chunks = [calls[i:i + size] for i in range(0, len(calls), size)]
+        results = [_quantity(result) for chunk in self.pool.map(self._rpc_batch, chunks) for result in chunk]
+        for address, balance in zip(addresses, results):
+            if balance is not None:
+                self.accounts[address] = balance / 1000000000000000000
+                self._seen('accounts', address)
         log.debug('Accounts: {}'.format(self.accounts))
+        self._set_tokens(pairs, results[len(addresses):])
 
-    def collect(self):
+    def _refresh(self):
+        if settings['etherscan_exporter']['backend'] == 'rpc':
+            return self._refresh_rpc()
+        block = None
+        if settings['etherscan_exporter']['change_detection']:
+            block = self._get_block()
+            log.debug('Latest block: {}'.format(block))
+        self._get_balances(block)
+        self._get_tokens(block)
+
+    def _collect(self):
         metrics = {
             'account_balance': GaugeMetricFamily(
                 'account_balance',
@@ -130,7 +551,6 @@ class EtherscanCollector:
                 labels=['source_currency', 'currency', 'account', 'type']
             ),
         }
-        self._get_balances()
         for account in self.accounts:
             metrics['account_balance'].add_metric(
                 value=(self.accounts[account]),
@@ -142,14 +562,26 @@ class EtherscanCollector:
                 ]
             )
 
-        self._get_tokens()
-        for token in self.tokens:
+        # The discovered tokens using the symbol of a configured token, or of another token of the account (e.g. spam
+        # airdrops), are labelled with their contract address
+        configured = set(token['short'] for token in self.configured.values())
+        discovered = {}
+        for token in self.tokens.values():
+            if token['contract_address'].lower() not in self.configured:
+                symbol = (token['account'], token['name_short'])
+                discovered[symbol] = discovered.get(symbol, 0) + 1
+        for token in self.tokens.values():
+            currency = token['name_short']
+            if token['contract_address'].lower() not in self.configured and (
+                currency in configured or discovered[(token['account'], currency)] > 1
+            ):
+                currency = token['contract_address'].lower()
             metrics['account_balance'].add_metric(
-                value=(self.tokens[token]['value']),
+                value=(token['value']),
                 labels=[
-                    self.tokens[token]['name_short'],
-                    self.tokens[token]['name_short'],
-                    self.tokens[token]['account'],
+                    currency,
+                    currency,
+                    token['account'],
                     'etherscan'
                 ]
             )
@@ -158,17 +590,21 @@ class EtherscanCollector:
 
 
 def _collect_to_text():
+    e = EtherscanCollector()
     while True:
-        e = EtherscanCollector()
+        e.refresh()
         write_to_textfile('{0}/etherscan_exporter.prom'.format(settings['etherscan_exporter']['prom_folder']), e)
         time.sleep(int(settings['etherscan_exporter']['interval']))
 
 
 def _collect_to_http():
-    REGISTRY.register(EtherscanCollector())
-    start_http_server(int(settings['etherscan_exporter']['listen_port']))
-    while True:
-        time.sleep(int(settings['etherscan_exporter']['interval']))
+    e = EtherscanCollector()
+    REGISTRY.register(e)
+    exposition = Exposition(REGISTRY)
+    start_http_server(int(settings['etherscan_exporter']['listen_port']), exposition)
+    poller = Poller(e.refresh, int(settings['etherscan_exporter']['interval']), exposition.render)
+    poller.start()
+    poller.join()
 
 
 if __name__ == '__main__':
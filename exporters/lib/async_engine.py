@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import aiohttp
+import ccxt
+import ccxt.async_support
+from lib.ccxt_collector import CcxtCollector, PRICES_ERRORS
+from lib.markets import MarketCache
+
+log = logging.getLogger(__name__)
+
+
+class AsyncEngine:
+    """
+    Refreshes the collectors on a single asyncio event loop.
+
+    The ccxt collectors are driven through `ccxt.async_support`, and all their exchanges share one pooled aiohttp
+    session. The other collectors are refreshed on the thread `pool`.
+    """
+
+    def __init__(self, collectors, pool, connections=100):
+        self.collectors = collectors
+        self.pool = pool
+        self.connections = connections
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.exchanges = {}
+        self.markets = {}
+
+    def refresh(self):
+        self.loop.run_until_complete(self._refresh())
+
+    async def _refresh(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        names = list(self.collectors)
+        tasks = []
+        for name in names:
+            collector = self.collectors[name]
+            if isinstance(collector, CcxtCollector) and not collector.streaming:
+                tasks.append(self._refreshCcxt(name, collector))
+            else:
+                tasks.append(self.loop.run_in_executor(self.pool, collector.refresh))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                log.warning('Could not refresh {}: {}'.format(name, result))
+
+    def _exchange(self, name, collector):
+        if name not in self.exchanges:
+            self.exchanges[name] = collector._exchange(ccxt.async_support, {
+                'session': self.session,
+                'asyncio_loop': self.loop,
+            })
+            self.markets[name] = MarketCache(self.exchanges[name], collector.markets.ttl, collector.markets.path)
+        return self.exchanges[name]
+
+    async def _refreshCcxt(self, name, collector):
+        exchange = self._exchange(name, collector)
+        if not await self.markets[name].load_async():
+            return
+        collector._indexMarkets(exchange)
+
+        (prices, tickers), accounts = await asyncio.gather(
+            self._getTickers(collector, exchange),
+            self._getAccounts(collector, exchange),
+        )
+        if prices is not None:
+            collector._setPrices(prices)
+        else:
+            collector._setTickers(tickers)
+        if accounts is not None:
+            collector._setAccounts(accounts)
+        collector.refreshed()
+
+    async def _getPrices(self, collector, exchange):
+        try:
+            response = collector._requestPrices(exchange)
+            if response is None:
+                return None
+            prices = collector._parsePrices(await response, collector._indexMarkets(exchange))
+        except PRICES_ERRORS as e:
+            return collector._pricesFailed(e)
+        return prices
+
+    async def _getTickers(self, collector, exchange):
+        """
+        Returns the last prices by symbol and None if the exchange has a price-only endpoint, None and the tickers
+        otherwise.
+        """
+        prices = await self._getPrices(collector, exchange)
+        if prices is not None:
+            return prices, None
+        tickers = {}
+        if exchange.has['fetchTickers']:
+            try:
+                tickers = await exchange.fetch_tickers()
+            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+                log.warning('{}'.format(e))
+        else:
+            symbols = list(exchange.symbols)
+            results = await asyncio.gather(*[self._fetchTicker(collector, exchange, symbol) for symbol in symbols])
+            for symbol, ticker in zip(symbols, results):
+                if ticker:
+                    tickers.update({symbol: ticker})
+        return None, tickers
+
+    async def _fetchTicker(self, collector, exchange, symbol):
+        await collector.limiter.acquire_async()
+        try:
+            return {'last': (await exchange.fetch_ticker(symbol))['last']}
+        except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+            log.warning('{}'.format(e))
+
+    async def _getAccounts(self, collector, exchange):
+        if collector.hasApiCredentials:
+            try:
+                return await exchange.fetch_balance()
+            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+                log.warning('{}'.format(e))
+            except (ccxt.ExchangeError) as e:
+                if not collector.disableAccountsOnError:
+                    raise
+                collector._disableAccounts(e)
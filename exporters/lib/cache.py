@@ -0,0 +1,41 @@
+import json
+import logging
+import os
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def load(path):
+    """
+    Reads the JSON file `path`. Returns None if it doesn't exist or can't be read.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning('Could not read {}: {}'.format(path, e))
+        return None
+
+
+def save(path, data):
+    """
+    Writes `data` to the JSON file `path`, atomically: readers see either the previous or the new file.
+    """
+    folder = os.path.dirname(path)
+    tmp = None
+    try:
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix='.{}.'.format(os.path.basename(path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, path)
+    except (OSError, TypeError, ValueError) as e:
+        log.warning('Could not write {}: {}'.format(path, e))
+        if tmp:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
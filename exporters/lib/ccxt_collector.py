@@ -0,0 +1,246 @@
+import logging
+import ccxt
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client.core import GaugeMetricFamily
+from lib.collector import Collector
+from lib.markets import MarketCache
+from lib.ratelimit import TokenBucket
+from lib.rates import BalanceTable, RateTable
+
+log = logging.getLogger(__name__)
+
+# The errors of the price-only endpoints: of ccxt, or of their parsing if their format changed
+PRICES_ERRORS = (ccxt.BaseError, AttributeError, KeyError, IndexError, TypeError, ValueError)
+
+
+class CcxtCollector(Collector):
+    """
+    Base class for the collectors of the exchanges supported by ccxt.
+
+    The subclasses set `name`, which is used for the `exchange` label, and `ccxt_name` if the ccxt class has a
+    different name. The collectors fed by a stream set `streaming`, so that they are always refreshed with `refresh()`.
+
+    The exporter only needs the last prices: the exchanges with a price-only endpoint implement `_requestPrices()` and
+    `_parsePrices()`, which are used instead of fetching the full tickers.
+    """
+    name = None
+    ccxt_name = None
+    state = ('rates', 'accounts')
+    series = ('rates', 'accounts')
+    hasApiCredentials = False
+    disableAccountsOnError = False
+    tickerWorkers = 8
+    streaming = False
+    indexed = None
+    ids = {}
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.rates = RateTable()
+        self.accounts = BalanceTable()
+        self.exchange = self._exchange(ccxt)
+        # rateLimit is the number of milliseconds between two requests
+        self.limiter = TokenBucket(1000 / self.exchange.rateLimit)
+        self.markets = MarketCache(
+            self.exchange,
+            int(settings['markets_ttl']),
+            self._cacheFile(settings.get('cache_folder'), 'markets'),
+            self._exchange(ccxt)
+        )
+        super().__init__(settings)
+        if settings.get('api_key') and settings.get('api_secret'):
+            self.hasApiCredentials = True
+        if settings.get('uid'):
+            self.hasApiCredentials = True
+
+    def _exchange(self, module, config=None):
+        """
+        Creates the exchange from the ccxt `module` (`ccxt` or `ccxt.async_support`), with the API credentials.
+        """
+        exchange_class = getattr(module, self.ccxt_name or self.name)
+        options = {'nonce': exchange_class.milliseconds}
+        options.update(config or {})
+        exchange = exchange_class(options)
+        if self.settings.get('api_key') and self.settings.get('api_secret'):
+            exchange.apiKey = self.settings.get('api_key')
+            exchange.secret = self.settings.get('api_secret')
+        if self.settings.get('uid'):
+            exchange.uid = self.settings.get('uid')
+        return exchange
+
+    def _indexMarkets(self, exchange):
+        """
+        Indexes the markets of the `exchange` when they are (re)loaded: gives their symbols a slot in the rates, and
+        returns the symbols by market id.
+        """
+        markets = exchange.markets
+        if markets is not self.indexed:
+            ids = {}
+            for symbol, market in (markets or {}).items():
+                # Several markets may share an id (spot, margin, swap...); the spot market wins
+                if market['id'] not in ids or market.get('spot'):
+                    ids[market['id']] = symbol
+            self.rates.index(markets or {})
+            self.ids, self.indexed = ids, markets
+        return self.ids
+
+    def _requestPrices(self, exchange):
+        """
+        Requests the last prices of all the markets to the price-only endpoint of the exchange. Returns the response
+        (a coroutine with `ccxt.async_support`), or None if the exchange has no such endpoint.
+        """
+        return None
+
+    def _parsePrices(self, response, ids):
+        """
+        Returns the last prices by symbol from the response of `_requestPrices()`, `ids` being the symbols by market id.
+        """
+        raise NotImplementedError
+
+    def _pricesFailed(self, e):
+        """
+        Handles an error of the price-only endpoint. Returns None to fall back to the full tickers, {} otherwise.
+        """
+        if isinstance(e, (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout)):
+            log.warning('{}'.format(e))
+            return {}
+        log.warning('Could not get the prices of {}, fetching the tickers: {}'.format(self.name, e))
+        return None
+
+    def _getPrices(self):
+        """
+        Gets the last prices from the price-only endpoint. Returns None if there is none, or if it failed.
+        """
+        try:
+            response = self._requestPrices(self.exchange)
+            if response is None:
+                return None
+            prices = self._parsePrices(response, self._indexMarkets(self.exchange))
+        except PRICES_ERRORS as e:
+            return self._pricesFailed(e)
+        return prices
+
+    def _getTickers(self):
+        """
+        Gets the price ticker.
+        """
+        if not self.markets.load():
+            return
+        self._indexMarkets(self.exchange)
+
+        prices = self._getPrices()
+        if prices is not None:
+            log.debug('Loaded the prices')
+            self._setPrices(prices)
+            return
+        if self.exchange.has['fetchTickers']:
+            tickers = {}
+            log.debug('Loading Tickers')
+            try:
+                tickers = self.exchange.fetch_tickers()
+            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+                log.warning('{}'.format(e))
+        else:
+            tickers = {}
+            symbols = list(self.exchange.symbols)
+            with ThreadPoolExecutor(max_workers=self.tickerWorkers) as pool:
+                for symbol, ticker in zip(symbols, pool.map(self._fetchTicker, symbols)):
+                    if ticker:
+                        tickers.update({symbol: ticker})
+
+        self._setTickers(tickers)
+
+    def _fetchTicker(self, symbol):
+        """
+        Fetches the ticker of one symbol, for the exchanges that can't fetch all the tickers at once.
+        """
+        self.limiter.acquire()
+        log.debug('Loading Symbol {}'.format(symbol))
+        try:
+            return {'last': self.exchange.fetch_ticker(symbol)['last']}
+        except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+            log.warning('{}'.format(e))
+
+    def _setTickers(self, tickers):
+        rates = self.rates
+        for ticker in tickers:
+            last = tickers[ticker].get('last')
+            if last and rates.set(ticker, float(last)):
+                self._seen('rates', ticker)
+
+        log.debug('Found {} ticker rates'.format(len(rates)))
+
+    def _setPrices(self, prices):
+        """
+        Sets the rates from the last prices by symbol, as given by the price-only endpoints and the streams.
+        """
+        rates = self.rates
+        for symbol, price in prices.items():
+            if price and rates.set(symbol, price):
+                self._seen('rates', symbol)
+
+        log.debug('Found {} ticker rates'.format(len(rates)))
+
+    def _getAccounts(self):
+        if self.hasApiCredentials:
+            try:
+                self._setAccounts(self.exchange.fetch_balance())
+            except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+                log.warning('{}'.format(e))
+            except (ccxt.ExchangeError) as e:
+                if not self.disableAccountsOnError:
+                    raise
+                self._disableAccounts(e)
+
+    def _disableAccounts(self, e):
+        self.hasApiCredentials = False
+        log.warning('Cannot access the API with the credentials provided. Disabling account metrics.')
+        log.warning('{}'.format(e))
+
+    def _setAccounts(self, accounts):
+        for currency in self.accounts.replace(accounts):
+            self._seen('accounts', currency)
+
+        log.debug('Found the following accounts: {}'.format(self.accounts.dump()))
+
+    def _refresh(self):
+        self._getTickers()
+        self._getAccounts()
+
+    def _collect(self):
+        metrics = {
+            'exchange_rate': GaugeMetricFamily(
+                'exchange_rate',
+                'Current exchange rates',
+                labels=['source_currency', 'target_currency', 'exchange']
+            ),
+            'account_balance': GaugeMetricFamily(
+                'account_balance',
+                'Account Balance',
+                labels=['source_currency', 'currency', 'account', 'type']
+            ),
+        }
+        for source_currency, target_currency, value in self.rates.rows():
+            metrics['exchange_rate'].add_metric(
+                value=value,
+                labels=[
+                    source_currency,
+                    target_currency,
+                    self.name
+                ]
+            )
+
+        for currency, account_type, value in self.accounts.rows():  # free / used
+            if (value > 0):
+                metrics['account_balance'].add_metric(
+                    value=value,
+                    labels=[
+                        currency,
+                        currency,
+                        account_type,
+                        self.name
+                    ]
+                )
+
+        for m in metrics.values():
+            yield m
@@ -0,0 +1,193 @@
+import logging
+import os
+import time
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from lib import cache
+from lib.rates import Table
+
+log = logging.getLogger(__name__)
+
+
+class Collector:
+    """
+    Base class for the collectors.
+
+    The data is gathered by `refresh()`, which also renders the metrics. `collect()` only serves the metrics of the
+    last refresh, so a scrape never waits for the exchange.
+
+    The attributes listed in `state` are saved after each refresh in the `cache_folder`, so that a restarted exporter
+    serves the last known values right away. The tables of `lib.rates` save and load themselves. A snapshot that can't
+    be restored is ignored.
+
+    The attributes listed in `series` are dicts with one series per key. The collector calls `_seen()` for every key
+    it updates; the keys that are not updated for `series_ttl` seconds, or `series_max_misses` refreshes, are evicted.
+    """
+    name = None
+    state = ()
+    series = ()
+    metrics = []
+    snapshotFile = None
+    session = None
+    updated = 0
+    evicted = 0
+
+    def __init__(self, settings=None):
+        settings = settings or {}
+        self.seriesTtl = int(settings.get('series_ttl') or 0)
+        self.seriesMaxMisses = int(settings.get('series_max_misses') or 0)
+        self.stamps = {}
+        self.seen = set()
+        self.restore(self._cacheFile(settings.get('cache_folder'), 'snapshot'))
+
+    def _refresh(self):
+        """
+        Fetches the data from the exchange / API. Implemented by every collector.
+        """
+        raise NotImplementedError
+
+    def _collect(self):
+        """
+        Yields the metric families, built from the data gathered by `_refresh()`. Implemented by every collector.
+        """
+        raise NotImplementedError
+
+    def _cacheFile(self, folder, kind):
+        if folder:
+            return os.path.join(folder, '{}_{}.json'.format(self.name, kind))
+
+    def _seen(self, table, key):
+        """
+        Marks the series `key` of the attribute `table` as updated by the current refresh.
+        """
+        self.seen.add((table, key))
+
+    def refresh(self):
+        self._refresh()
+        self.refreshed()
+
+    def refreshed(self):
+        """
+        Called once the data has been gathered: evicts the stale series, renders the metrics and saves the snapshot.
+        """
+        self.updated = time.time()
+        self._evict()
+        self.publish()
+        if self.snapshotFile:
+            cache.save(self.snapshotFile, {
+                'timestamp': self.updated,
+                'state': {attr: self._dumpState(attr) for attr in self.state},
+                'stamps': self.stamps,
+            })
+
+    def _dumpState(self, attr):
+        """
+        Returns the attribute `attr` as saved in the snapshot.
+        """
+        value = getattr(self, attr)
+        return value.dump() if isinstance(value, Table) else value
+
+    def _loadState(self, attr, value):
+        """
+        Sets the attribute `attr` from the snapshot.
+        """
+        if isinstance(getattr(self, attr, None), Table):
+            getattr(self, attr).load(value)
+        else:
+            setattr(self, attr, value)
+
+    def _evict(self):
+        seen, self.seen = self.seen, set()
+        for table in self.series:
+            entries = getattr(self, table)
+            stamps = self.stamps.setdefault(table, {})
+            for key in list(entries):
+                stamp = stamps.get(key)
+                if stamp is None or (table, key) in seen:
+                    stamp = stamps[key] = [self.updated, 0]  # last update, missed refreshes
+                else:
+                    stamp[1] += 1
+                if (
+                    (self.seriesTtl and self.updated - stamp[0] > self.seriesTtl)
+                    or (self.seriesMaxMisses and stamp[1] > self.seriesMaxMisses)
+                ):
+                    log.debug('Evicting {} {} of {}'.format(table, key, self.name))
+                    del entries[key]
+                    self.evicted += 1
+            for key in list(stamps):
+                if key not in entries:
+                    del stamps[key]
+
+    def restore(self, path):
+        """
+        Loads the snapshot saved in `path` by the last refresh, and keeps saving it there.
+        """
+        self.snapshotFile = path
+        data = cache.load(path) if path else None
+        if not data:
+            return
+        initial = dict((attr, getattr(self, attr, None)) for attr in self.state)
+        try:
+            for attr in self.state:
+                if attr in data['state']:
+                    self._loadState(attr, data['state'][attr])
+            self.stamps = dict(data.get('stamps', {}))
+            self.updated = float(data['timestamp'])
+            self.publish()
+        except Exception as e:
+            # e.g. saved by another version of the exporter
+            log.warning('Ignoring the snapshot of {} in {}: {!r}'.format(self.name, path, e))
+            for attr, value in initial.items():
+                if isinstance(value, Table):
+                    for key in list(value.slots):
+                        del value[key]
+                else:
+                    setattr(self, attr, value)
+            self.stamps = {}
+            self.updated = 0
+            self.metrics = []
+            return
+        log.info('Restored the snapshot of {} from {}'.format(self.name, path))
+
+    def publish(self):
+        """
+        Renders the metrics from the data gathered so far.
+        """
+        metrics = list(self._collect())
+        if self.state and self.updated:
+            metrics.extend(self._collectExporter())
+        self.metrics = metrics
+        log.debug('Refreshed {} metric families for {}'.format(len(self.metrics), type(self).__name__))
+
+    def _collectExporter(self):
+        """
+        Yields the metrics about the exporter itself.
+        """
+        snapshot = GaugeMetricFamily(
+            'exporter_snapshot_timestamp_seconds',
+            'When the exported data was gathered',
+            labels=['exporter']
+        )
+        snapshot.add_metric(value=self.updated, labels=[self.name])
+        yield snapshot
+
+        series = GaugeMetricFamily(
+            'exporter_series',
+            'Series currently exported',
+            labels=['exporter']
+        )
+        series.add_metric(value=sum(len(getattr(self, table)) for table in self.series), labels=[self.name])
+        yield series
+
+        evicted = CounterMetricFamily(
+            'exporter_evicted_series',
+            'Series not exported anymore, because they were not updated anymore',
+            labels=['exporter']
+        )
+        evicted.add_metric(value=self.evicted, labels=[self.name])
+        yield evicted
+
+        if self.session:
+            yield from self.session.collect(self.name)
+
+    def collect(self):
+        return iter(self.metrics)
@@ -0,0 +1,70 @@
+import gzip
+import hashlib
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+log = logging.getLogger(__name__)
+
+
+class Exposition:
+    """
+    The text exposition of a `registry`, rendered once per refresh instead of once per scrape. A gzip compressed copy
+    and an ETag are kept along.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.render()
+
+    def render(self):
+        data = generate_latest(self.registry)
+        # Replaced at once, so a scrape never mixes two renderings
+        self.rendered = (data, gzip.compress(data), '"{}"'.format(hashlib.sha1(data).hexdigest()))
+        log.debug('Rendered {} bytes'.format(len(data)))
+
+
+class ExpositionHandler(BaseHTTPRequestHandler):
+    exposition = None
+
+    def do_GET(self):
+        data, gzipped, etag = self.exposition.rendered
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        headers = {}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzipped
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, exposition, addr=''):
+    """
+    Serves the pre-rendered `exposition` on `port`, from a daemon thread.
+    """
+    handler = type('Handler', (ExpositionHandler,), {'exposition': exposition})
+    httpd = ThreadingHTTPServer((addr, port), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
@@ -0,0 +1,78 @@
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+
+log = logging.getLogger(__name__)
+
+
+class Session(requests.Session):
+    """
+    A requests session keeping the connections alive, with explicit (connect, read) timeouts.
+
+    `pool()` gives a host its own connection pool, sized for the number of requests sent to it at the same time.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=30, pool_size=10):
+        super().__init__()
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.mount('https://', HTTPAdapter(pool_maxsize=int(pool_size)))
+        self.mount('http://', HTTPAdapter(pool_maxsize=int(pool_size)))
+
+    def pool(self, url, size):
+        """
+        Mounts a connection pool of `size` connections for the host of `url`.
+        """
+        parts = urlsplit(url)
+        prefix = '{}://{}/'.format(parts.scheme, parts.netloc)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(size))
+        self.mount(prefix, adapter)
+        return self
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+    def _counts(self):
+        """
+        Returns the number of requests and of new connections per host, from the connection pools still open.
+        """
+        counts = {}
+        for adapter in self.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count, connections = counts.get(pool.host, (0, 0))
+                counts[pool.host] = (requests_count + pool.num_requests, connections + pool.num_connections)
+        return counts
+
+    def collect(self, exporter):
+        """
+        Yields the metrics about the connection reuse, for the `exporter`.
+        """
+        requests_total = CounterMetricFamily(
+            'exporter_http_requests',
+            'HTTP requests sent',
+            labels=['exporter', 'host']
+        )
+        connections_total = CounterMetricFamily(
+            'exporter_http_connections',
+            'HTTP connections opened',
+            labels=['exporter', 'host']
+        )
+        reuse = GaugeMetricFamily(
+            'exporter_http_connection_reuse_ratio',
+            'Share of the HTTP requests sent over a connection that was already open',
+            labels=['exporter', 'host']
+        )
+        for host, (requests_count, connections) in self._counts().items():
+            requests_total.add_metric(value=requests_count, labels=[exporter, host])
+            connections_total.add_metric(value=connections, labels=[exporter, host])
+            if requests_count:
+                reuse.add_metric(value=1 - connections / requests_count, labels=[exporter, host])
+        yield requests_total
+        yield connections_total
+        yield reuse
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import threading
+import time
+import ccxt
+from lib import cache
+
+log = logging.getLogger(__name__)
+
+
+class MarketCache:
+    """
+    Keeps the markets of a ccxt `exchange` loaded. They are downloaded once, then reloaded in the background once they
+    are older than `ttl` seconds, while the cached markets keep being used.
+
+    If `path` is set, the markets are also saved there, and read from it at startup, so the exporter doesn't have to
+    wait for the exchange. They are then revalidated in the background.
+
+    The sync exchanges are used by the refresh while the markets reload: they are reloaded on `loader`, another
+    instance of the exchange, and swapped in by the next `load()`.
+    """
+
+    def __init__(self, exchange, ttl, path=None, loader=None):
+        self.exchange = exchange
+        self.loader = loader or exchange
+        self.ttl = ttl
+        self.path = path
+        self.loaded = 0
+        self.reloading = False
+        self.reloaded = None
+        self.lock = threading.Lock()
+        self._read()
+
+    def _read(self):
+        if not self.path:
+            return
+        data = cache.load(self.path)
+        if not data:
+            return
+        try:
+            if not data.get('markets'):
+                return
+            # Revalidate on the first load
+            loaded = float(data['timestamp']) - self.ttl
+            self.exchange.set_markets(data['markets'], data.get('currencies'))
+        except Exception as e:
+            # e.g. written by another version of ccxt
+            log.warning('Ignoring the markets cached in {}: {!r}'.format(self.path, e))
+            return
+        self.loaded = loaded
+        log.debug('Read {} markets from {}'.format(len(data['markets']), self.path))
+
+    def _write(self, exchange):
+        if self.path:
+            cache.save(self.path, {
+                'timestamp': self.loaded,
+                'markets': exchange.markets,
+                'currencies': exchange.currencies,
+            })
+
+    def _stale(self):
+        return not self.reloading and time.time() - self.loaded > self.ttl
+
+    def load(self):
+        """
+        Returns True if the markets are available.
+        """
+        if not self.loaded:
+            self._reload()
+        elif self._stale():
+            self.reloading = True
+            threading.Thread(target=self._reload, daemon=True).start()
+        with self.lock:
+            reloaded, self.reloaded = self.reloaded, None
+        if reloaded:
+            self.exchange.set_markets(*reloaded)
+        return bool(self.loaded)
+
+    def _reload(self):
+        log.debug('Loading Markets for {}'.format(self.exchange.id))
+        try:
+            self.loader.load_markets(True)
+            if self.loader is not self.exchange:
+                with self.lock:
+                    self.reloaded = (self.loader.markets, self.loader.currencies)
+            self.loaded = time.time()
+            self._write(self.loader)
+        except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+            log.warning('{}'.format(e))
+        finally:
+            self.reloading = False
+
+    async def load_async(self):
+        """
+        Same as `load()`, for the exchanges from `ccxt.async_support`.
+        """
+        if not self.loaded:
+            await self._reload_async()
+        elif self._stale():
+            self.reloading = True
+            asyncio.ensure_future(self._reload_async())
+        return bool(self.loaded)
+
+    async def _reload_async(self):
+        log.debug('Loading Markets for {}'.format(self.exchange.id))
+        try:
+            await self.exchange.load_markets(True)
+            self.loaded = time.time()
+            self._write(self.exchange)
+        except (ccxt.ExchangeNotAvailable, ccxt.RequestTimeout) as e:
+            log.warning('{}'.format(e))
+        finally:
+            self.reloading = False
@@ -0,0 +1,30 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Poller(threading.Thread):
+    """
+    Calls `refresh` every `interval` seconds, in the background, then `rendered` if set.
+    """
+
+    def __init__(self, refresh, interval, rendered=None):
+        super().__init__(daemon=True)
+        self.refresh = refresh
+        self.interval = interval
+        self.rendered = rendered
+
+    def run(self):
+        while True:
+            start = time.time()
+            try:
+                self.refresh()
+            except Exception as e:
+                log.exception('Refresh failed: {}'.format(e))
+            if self.rendered:
+                self.rendered()
+            elapsed = time.time() - start
+            log.debug('Refresh took {:.3f}s'.format(elapsed))
+            time.sleep(max(self.interval - elapsed, 0))
@@ -0,0 +1,35 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second, with bursts of up to `capacity` calls. Shared by threads and coroutines.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Takes a token and returns how many seconds the caller has to wait before it can use it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        time.sleep(self._reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self._reserve())
@@ -0,0 +1,190 @@
+import sys
+import threading
+from array import array
+
+NAN = float('nan')
+
+
+class Store:
+    """
+    The values of the series of all the collectors, in one array of floats, and their labels, in a parallel list of
+    tuples of interned strings. The collectors own slots of the store through their tables.
+    """
+
+    def __init__(self):
+        self.values = array('d')
+        self.labels = []
+        self.free = []
+        self.lock = threading.Lock()
+
+    def allocate(self, labels):
+        labels = tuple(sys.intern(label) for label in labels)
+        with self.lock:
+            if self.free:
+                slot = self.free.pop()
+                self.labels[slot] = labels
+            else:
+                slot = len(self.values)
+                self.values.append(NAN)
+                self.labels.append(labels)
+        return slot
+
+    def release(self, slot):
+        with self.lock:
+            self.values[slot] = NAN
+            self.labels[slot] = None
+            self.free.append(slot)
+
+
+STORE = Store()
+
+
+class Table:
+    """
+    Series of a collector by key, stored in the shared `STORE`: every key has a slot per column.
+
+    The slots without a value (NaN) are not exported, and the table iterates over the keys with a value, like a dict.
+    The tables are saved in the snapshots with `dump()`, and restored with `load()`.
+    """
+    columns = (None,)
+
+    def __init__(self, store=STORE):
+        self.store = store
+        self.slots = {}
+
+    def _labels(self, key):
+        """
+        Returns the labels of `key`, or None if it can't be exported.
+        """
+        return (key,)
+
+    def _slots(self, key):
+        slots = self.slots.get(key)
+        if slots is None:
+            labels = self._labels(key)
+            if labels is None:
+                return None
+            slots = self.slots[key] = tuple(
+                self.store.allocate(labels if column is None else labels + (column,)) for column in self.columns
+            )
+        return slots
+
+    def rows(self):
+        """
+        Yields the labels of the slots with a value, followed by the value.
+        """
+        values = self.store.values
+        labels = self.store.labels
+        for slots in self.slots.values():
+            for slot in slots:
+                value = values[slot]
+                if value == value:
+                    yield labels[slot] + (value,)
+
+    def __contains__(self, key):
+        values = self.store.values
+        return any(values[slot] == values[slot] for slot in self.slots.get(key, ()))
+
+    def __iter__(self):
+        return iter([key for key in self.slots if key in self])
+
+    def __len__(self):
+        return sum(1 for key in self.slots if key in self)
+
+    def __delitem__(self, key):
+        for slot in self.slots.pop(key):
+            self.store.release(slot)
+
+
+class RateTable(Table):
+    """
+    The exchange rates of a collector, by symbol (`BTC/USD`), with the (source, target) currencies as labels.
+
+    `index()` gives the symbols of the markets their slot once per market load, so setting a rate is a write in the
+    store.
+    """
+
+    def _labels(self, symbol):
+        currencies = symbol.split('/')
+        if len(currencies) == 2:
+            return tuple(currencies)
+
+    def index(self, symbols):
+        """
+        Gives a slot to the `symbols`, and frees the slots of the other symbols without a rate.
+        """
+        for symbol in symbols:
+            self._slots(symbol)
+        symbols = set(symbols)
+        for symbol in list(self.slots):
+            if symbol not in symbols and symbol not in self:
+                del self[symbol]
+
+    def set(self, symbol, value):
+        """
+        Sets the rate of `symbol`. Returns False if the symbol is not a pair of currencies.
+        """
+        slots = self._slots(symbol)
+        if slots is None:
+            return False
+        self.store.values[slots[0]] = value
+        return True
+
+    def dump(self):
+        values = self.store.values
+        return dict((symbol, values[slots[0]]) for symbol, slots in self.slots.items() if symbol in self)
+
+    def load(self, rates):
+        """
+        Loads the rates saved by `dump()`, or in the former format of one dict per symbol.
+        """
+        for symbol, value in rates.items():
+            if isinstance(value, dict):
+                symbol = '{}/{}'.format(value['source_currency'], value['target_currency'])
+                value = value['value']
+            self.set(symbol, float(value))
+
+
+class BalanceTable(Table):
+    """
+    The balances of an exchange account, by currency, with a column per type of balance (free / used).
+    """
+    columns = ('free', 'used')
+
+    def replace(self, balances):
+        """
+        Replaces the balances with the `balances` by type, then by currency (as given by ccxt). Returns the currencies.
+        """
+        values = self.store.values
+        for slots in self.slots.values():
+            for slot in slots:
+                values[slot] = NAN
+        currencies = set()
+        for column, account_type in enumerate(self.columns):
+            for currency, value in (balances.get(account_type) or {}).items():
+                if value is not None:
+                    values[self._slots(currency)[column]] = value
+                    currencies.add(currency)
+        for currency in list(self.slots):
+            if currency not in self:
+                del self[currency]
+        return currencies
+
+    def dump(self):
+        values = self.store.values
+        balances = {}
+        for currency, slots in self.slots.items():
+            for account_type, slot in zip(self.columns, slots):
+                if values[slot] == values[slot]:
+                    balances.setdefault(currency, {})[account_type] = values[slot]
+        return balances
+
+    def load(self, balances):
+        """
+        Loads the balances saved by `dump()`.
+        """
+        by_type = {}
+        for currency, types in balances.items():
+            for account_type, value in types.items():
+                by_type.setdefault(account_type, {})[currency] = value
+        self.replace(by_type)
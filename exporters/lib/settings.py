@@ -0,0 +1,33 @@
+import logging
+import os
+import yaml
+
+log = logging.getLogger(__name__)
+
+
+def read_config(config_file):
+    """
+    Loads the YAML configuration file. Returns an empty configuration if the file doesn't exist.
+    """
+    cfg = {}
+    if os.path.isfile(config_file):
+        with open(config_file, 'r') as ymlfile:
+            cfg = yaml.safe_load(ymlfile) or {}
+    else:
+        log.warning('Config file {} not found'.format(config_file))
+    return cfg
+
+
+def load_settings(defaults, cfg):
+    """
+    Overrides the `defaults` with the options set in `cfg` (the exporter's section of the configuration file).
+    """
+    settings = dict(defaults)
+    if cfg:
+        for option in defaults:
+            if option == 'export' and cfg.get(option) not in ['text', 'http']:
+                continue
+            # An option set to 0 or false overrides its default, a blank one doesn't
+            if cfg.get(option) is not None:
+                settings[option] = cfg[option]
+    return settings
@@ -0,0 +1,31 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def events(lines):
+    """
+    Parses a stream of server-sent events, from its decoded lines (as given by `Response.iter_lines()`). Yields the
+    (id, event, data) of every event; the id is the last one received, as for `Last-Event-ID`.
+    """
+    last_id = None
+    event = None
+    data = []
+    for line in lines:
+        if not line:
+            if data:
+                yield last_id, event or 'message', '\n'.join(data)
+            event = None
+            data = []
+            continue
+        if line.startswith(':'):
+            continue
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'id':
+            last_id = value
+        elif field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
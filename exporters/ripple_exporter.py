@@ -3,12 +3,17 @@
 import logging
 import time
 import os
-import yaml
 import sys
 import requests
 import json
-from prometheus_client import write_to_textfile, start_http_server
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import write_to_textfile
 from prometheus_client.core import REGISTRY, GaugeMetricFamily, CounterMetricFamily
+from lib.collector import Collector
+from lib.exposition import Exposition, start_http_server
+from lib.http import Session
+from lib.poller import Poller
+from lib.settings import read_config, load_settings
 
 log = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
@@ -16,45 +21,134 @@ logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
 settings = {}
 
 
-def _settings():
+def _settings(cfg=None):
     global settings
 
+    if cfg is None:
+        cfg = read_config('/etc/ripple_exporter/ripple_exporter.yaml')
     settings = {
-        'ripple_exporter': {
+        'ripple_exporter': load_settings({
             'prom_folder': '/var/lib/node_exporter',
             'interval': 60,
             'url': 'https://data.ripple.com',
             'addresses': [],
             'export': 'text',
             'listen_port': 9306,
-        },
+            'cache_folder': '/var/cache/ticker_exporter',
+            'series_ttl': 3600,
+            'series_max_misses': 0,
+            'connect_timeout': 5,
+            'read_timeout': 30,
+            'pool_size': 10,
+            'backend': 'data',
+        }, cfg.get('ripple_exporter')),
     }
-    config_file = '/etc/ripple_exporter/ripple_exporter.yaml'
-    cfg = {}
-    if os.path.isfile(config_file):
-        with open(config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
-    else:
-        log.warning('Config file not found')
-    if cfg.get('ripple_exporter'):
-        if cfg['ripple_exporter'].get('prom_folder'):
-            settings['ripple_exporter']['prom_folder'] = cfg['ripple_exporter']['prom_folder']
-        if cfg['ripple_exporter'].get('interval'):
-            settings['ripple_exporter']['interval'] = cfg['ripple_exporter']['interval']
-        if cfg['ripple_exporter'].get('url'):
-            settings['ripple_exporter']['url'] = cfg['ripple_exporter']['url']
-        if cfg['ripple_exporter'].get('addresses'):
-            settings['ripple_exporter']['addresses'] = cfg['ripple_exporter']['addresses']
-        if cfg['ripple_exporter'].get('export') in ['text', 'http']:
-            settings['ripple_exporter']['export'] = cfg['ripple_exporter']['export']
-        if cfg['ripple_exporter'].get('listen_port'):
-            settings['ripple_exporter']['listen_port'] = cfg['ripple_exporter']['listen_port']
-
-
-class RippleCollector:
-    accounts = {}
+
+
+class RippleCollector(Collector):
+    name = 'ripple'
+    state = ('balances', 'ledgers')
+    series = ('balances',)
+
+    def __init__(self):
+        self.balances = {}
+        self.ledgers = {}
+        self.pool = ThreadPoolExecutor(max_workers=int(settings['ripple_exporter']['pool_size']))
+        self.session = Session(
+            connect_timeout=settings['ripple_exporter']['connect_timeout'],
+            read_timeout=settings['ripple_exporter']['read_timeout'],
+        ).pool(settings['ripple_exporter']['url'], settings['ripple_exporter']['pool_size'])
+        super().__init__(settings['ripple_exporter'])
+
+    def _rpc(self, method, params):
+        """
+        Sends a JSON-RPC request to the rippled node. Returns its result, or None if it failed.
+        """
+        try:
+            r = self.session.post(settings['ripple_exporter']['url'], json={
+                'method': method,
+                'params': [params],
+            }).json()
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+            ValueError
+        ) as e:
+            log.warning("Can't connect to {}. The error received follows.".format(
+                settings['ripple_exporter']['url']
+            ))
+            log.warning(e)
+            return None
+        result = r.get('result', {})
+        if result.get('status') != 'success':
+            log.warning('{} failed: {}'.format(method, result.get('error_message') or result.get('error')))
+            return None
+        return result
+
+    def _get_balance_rippled(self, address):
+        """
+        Returns the balances of `address` by currency from the rippled node, or None if they can't be fetched.
+        """
+        info = self._rpc('account_info', {'account': address, 'ledger_index': 'validated'})
+        if info is None:
+            return None
+        balances = {'XRP': int(info['account_data']['Balance']) / 1000000}
+        params = {'account': address, 'ledger_index': info['ledger_index']}
+        while True:
+            lines = self._rpc('account_lines', params)
+            if lines is None:
+                return None
+            for line in lines['lines']:
+                balances[line['currency']] = balances.get(line['currency'], 0) + float(line['balance'])
+            if not lines.get('marker'):
+                return balances
+            params['marker'] = lines['marker']
+
+    def _get_last_ledger(self, address):
+        """
+        Returns the index of the last ledger with a transaction of `address`, or None if it can't be fetched.
+        """
+        if settings['ripple_exporter']['backend'] == 'rippled':
+            r = self._rpc('account_tx', {
+                'account': address,
+                'ledger_index_min': -1,
+                'ledger_index_max': -1,
+                'limit': 1,
+                'forward': False,
+            })
+            transactions = (r or {}).get('transactions')
+        else:
+            url = '{}/v2/accounts/{}/transactions'.format(settings['ripple_exporter']['url'], address)
+            try:
+                r = self.session.get(url, params={'descending': 'true', 'limit': 1}).json()
+                transactions = r.get('transactions')
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ReadTimeout,
+                ValueError
+            ) as e:
+                log.warning(e)
+                return None
+        if transactions:
+            # rippled API v1 only has the ledger index in the transaction
+            return int(transactions[0].get('ledger_index') or transactions[0]['tx']['ledger_index'])
+
+    def _get_changes(self, address):
+        """
+        Returns the index of the last ledger with a transaction of `address`, and its balances if they changed since
+        the last refresh (None otherwise).
+        """
+        ledger = self._get_last_ledger(address)
+        if ledger is not None and address in self.balances and self.ledgers.get(address) == ledger:
+            return ledger, None
+        if settings['ripple_exporter']['backend'] == 'rippled':
+            return ledger, self._get_balance_rippled(address)
+        return ledger, self._get_balance(address)
 
     def _get_balance(self, address):
+        """
+        Returns the balances of `address` by currency from the Data API, or None if they can't be fetched.
+        """
         url = '{}/v2/accounts/{}/balances'.format(
             settings['ripple_exporter']['url'],
             address
@@ -62,36 +156,49 @@ class RippleCollector:
         log.debug('URL: {}'.format(url))
 
         try:
-            r = requests.get(url).json()
+            r = self.session.get(url).json()
             log.debug('Response: {}'.format(r))
         except (
             requests.exceptions.ConnectionError,
-            requests.exceptions.ReadTimeout
+            requests.exceptions.ReadTimeout,
+            ValueError
         ) as e:
             log.warning("Can't connect to {}. The error received follows.".format(
                 settings['ripple_exporter']['url']
             ))
             log.warning(e)
+            return None
 
         if r.get('result') == 'success' and r.get('balances'):
+            balances = {}
             for balance in r.get('balances'):
                 log.debug('Registering balance {balance} for the currency {currency} - account {account}'.format(
                     balance=balance['value'],
                     currency=balance['currency'],
                     account=address
                 ))
-                self.accounts.update({
-                    address: {
-                        'value': float(balance['value']),
-                        'currency': balance['currency'],
-                        'type': 'ripple',
-                    }
-                })
-        else:
-            log.warning('Could not retrieve balance. The result follows.')
-            log.warning('{}: {}'.format(r.get('result'), r.get('message')))
-
-    def collect(self):
+                # The lines of the same currency from several issuers add up
+                balances[balance['currency']] = balances.get(balance['currency'], 0) + float(balance['value'])
+            return balances
+        log.warning('Could not retrieve balance. The result follows.')
+        log.warning('{}: {}'.format(r.get('result'), r.get('message')))
+
+    def _refresh(self):
+        addresses = settings['ripple_exporter']['addresses']
+        for address, (ledger, balances) in zip(addresses, self.pool.map(self._get_changes, addresses)):
+            if balances is not None:
+                self.balances[address] = balances
+                if ledger is not None:
+                    self.ledgers[address] = ledger
+                self._seen('balances', address)
+            elif ledger is not None and self.ledgers.get(address) == ledger:
+                # No transaction since the last refresh
+                self._seen('balances', address)
+        for address in list(self.ledgers):
+            if address not in self.balances:
+                del self.ledgers[address]
+
+    def _collect(self):
         metrics = {
             'account_balance': GaugeMetricFamily(
                 'account_balance',
@@ -99,18 +206,17 @@ class RippleCollector:
                 labels=['source_currency', 'currency', 'account', 'type']
             ),
         }
-        for address in settings['ripple_exporter']['addresses']:
-            self._get_balance(address=address)
-        for account in self.accounts:
-            metrics['account_balance'].add_metric(
-                value=self.accounts[account]['value'],
-                labels=[
-                    self.accounts[account]['currency'],
-                    self.accounts[account]['currency'],
-                    account,
-                    self.accounts[account]['type']
-                ]
-            )
+        for account in self.balances:
+            for currency, value in self.balances[account].items():
+                metrics['account_balance'].add_metric(
+                    value=value,
+                    labels=[
+                        currency,
+                        currency,
+                        account,
+                        'ripple'
+                    ]
+                )
 
         for m in metrics.values():
             yield m
@@ -119,19 +225,23 @@ class RippleCollector:
 def _collect_to_text():
     e = RippleCollector()
     while True:
+        e.refresh()
         write_to_textfile('{0}/ripple_exporter.prom'.format(settings['ripple_exporter']['prom_folder']), e)
         time.sleep(int(settings['ripple_exporter']['interval']))
 
 
 def _collect_to_http():
-    REGISTRY.register(RippleCollector())
-    start_http_server(int(settings['ripple_exporter']['listen_port']))
-    while True:
-        time.sleep(int(settings['ripple_exporter']['interval']))
+    e = RippleCollector()
+    REGISTRY.register(e)
+    exposition = Exposition(REGISTRY)
+    start_http_server(int(settings['ripple_exporter']['listen_port']), exposition)
+    poller = Poller(e.refresh, int(settings['ripple_exporter']['interval']), exposition.render)
+    poller.start()
+    poller.join()
 
 
 if __name__ == '__main__':
-    settings()
+    _settings()
     log.debug('Loaded settings: {}'.format(settings))
     if settings['ripple_exporter']['export'] == 'text':
         _collect_to_text()
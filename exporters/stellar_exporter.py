@@ -3,75 +3,241 @@
 import logging
 import time
 import os
-import yaml
 import sys
 import requests
 import json
-from stellar_base.address import Address
-from prometheus_client import write_to_textfile, start_http_server
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import write_to_textfile
 from prometheus_client.core import REGISTRY, GaugeMetricFamily, CounterMetricFamily
+from lib.collector import Collector
+from lib import sse
+from lib.exposition import Exposition, start_http_server
+from lib.http import Session
+from lib.poller import Poller
+from lib.settings import read_config, load_settings
 
 log = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
 
 settings = {}
 
+# The longest wait, in seconds, before reconnecting a stream that keeps failing or ending
+STREAM_MAX_BACKOFF = 60
 
-def settings():
+
+def _settings(cfg=None):
     global settings
 
+    if cfg is None:
+        cfg = read_config('/etc/stellar_exporter/stellar_exporter.yaml')
     settings = {
-        'stellar_exporter': {
+        'stellar_exporter': load_settings({
             'prom_folder': '/var/lib/node_exporter',
             'interval': 30,
             'export': 'text',
             'listen_port': 9309,
+            'cache_folder': '/var/cache/ticker_exporter',
+            'series_ttl': 3600,
+            'series_max_misses': 0,
+            'connect_timeout': 5,
+            'read_timeout': 30,
+            'pool_size': 10,
+            'url': 'https://horizon.stellar.org',
+            'stream': False,
+            'stream_timeout': 300,
             'accounts': [],
-        },
+        }, cfg.get('stellar_exporter')),
     }
-    config_file = '/etc/stellar_exporter/stellar_exporter.yaml'
-    cfg = {}
-    if os.path.isfile(config_file):
-        with open(config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
-    if cfg.get('stellar_exporter'):
-        if cfg['stellar_exporter'].get('prom_folder'):
-            settings['stellar_exporter']['prom_folder'] = cfg['stellar_exporter']['prom_folder']
-        if cfg['stellar_exporter'].get('interval'):
-            settings['stellar_exporter']['interval'] = cfg['stellar_exporter']['interval']
-        if cfg['stellar_exporter'].get('export') in ['text', 'http']:
-            settings['stellar_exporter']['export'] = cfg['stellar_exporter']['export']
-        if cfg['stellar_exporter'].get('listen_port'):
-            settings['stellar_exporter']['listen_port'] = cfg['stellar_exporter']['listen_port']
-        if isinstance(cfg['stellar_exporter'].get('accounts'), list):
-            settings['stellar_exporter']['accounts'] = cfg['stellar_exporter']['accounts']
-
-
-class StellarCollector:
-    accounts = {}
-
-    def _getAccounts(self):
-        for account in settings['stellar_exporter']['accounts']:
-            a = Address(address=account, network='public')
-            a.get()
-            for balance in a.balances:
-                if balance.get('asset_code'):
-                    currency = balance.get('asset_code')
-                elif balance.get('asset_type') == 'native':
-                    currency = 'XLM'
-                else:
-                    currency = balance.get('asset_type')
-                self.accounts.update({
-                    '{}-{}'.format(account, currency): {
-                        'account': account,
-                        'currency': currency,
-                        'balance': float(balance.get('balance'))
-                    }
-                })
+
+
+class StellarCollector(Collector):
+    """
+    Fetches the balances of the accounts from Horizon.
+
+    In the `stream` mode, a thread per account follows its transactions with the Horizon event stream, and fetches the
+    balances again after each one. The cursor of each stream is saved in the snapshot, so a restarted exporter gets
+    the transactions it missed. The updates are applied by `refresh()`, which only polls the accounts whose stream is
+    down.
+    """
+    name = 'stellar'
+    state = ('accounts', 'cursors')
+    series = ('accounts',)
+
+    def __init__(self):
+        self.accounts = {}
+        self.cursors = {}
+        self.streams = {}
+        self.connected = set()
+        self.stale = set()
+        self.updates = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=int(settings['stellar_exporter']['pool_size']))
+        self.session = Session(
+            connect_timeout=settings['stellar_exporter']['connect_timeout'],
+            read_timeout=settings['stellar_exporter']['read_timeout'],
+        ).pool(settings['stellar_exporter']['url'], settings['stellar_exporter']['pool_size'])
+        # The streams keep their connection open, each one needs its own
+        self.streamSession = Session(
+            connect_timeout=settings['stellar_exporter']['connect_timeout'],
+            read_timeout=settings['stellar_exporter']['stream_timeout'],
+        ).pool(settings['stellar_exporter']['url'], max(len(settings['stellar_exporter']['accounts']), 1))
+        super().__init__(settings['stellar_exporter'])
+
+    def _getBalances(self, account):
+        """
+        Returns the balances of `account` by currency, or None if they can't be fetched.
+        """
+        try:
+            r = self.session.get('{}/accounts/{}'.format(settings['stellar_exporter']['url'], account))
+            r.raise_for_status()
+            balances = r.json()['balances']
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+            requests.exceptions.HTTPError,
+            KeyError,
+            ValueError
+        ) as e:
+            log.warning('Could not get the balances of {}: {}'.format(account, e))
+            return None
+        result = {}
+        for balance in balances:
+            if balance.get('asset_code'):
+                currency = balance.get('asset_code')
+            elif balance.get('asset_type') == 'native':
+                currency = 'XLM'
+            else:
+                currency = balance.get('asset_type')
+            result[currency] = float(balance.get('balance'))
+        return result
+
+    def _setBalances(self, account, balances):
+        for key in [key for key in self.accounts if self.accounts[key]['account'] == account]:
+            if self.accounts[key]['currency'] not in balances:
+                del self.accounts[key]
+        for currency in balances:
+            self.accounts.update({
+                '{}-{}'.format(account, currency): {
+                    'account': account,
+                    'currency': currency,
+                    'balance': balances[currency]
+                }
+            })
+            self._seen('accounts', '{}-{}'.format(account, currency))
+
+    def _getAccounts(self, accounts):
+        for account, balances in zip(accounts, self.pool.map(self._getBalances, accounts)):
+            if balances is None:
+                self.stale.add(account)
+            else:
+                self.stale.discard(account)
+                self._setBalances(account, balances)
 
         log.debug('Found the following accounts: {}'.format(self.accounts))
 
-    def collect(self):
+    def _getCursor(self, account):
+        """
+        Returns the paging token of the last transaction of `account`, to stream the ones that follow.
+        """
+        try:
+            r = self.session.get(
+                '{}/accounts/{}/transactions'.format(settings['stellar_exporter']['url'], account),
+                params={'order': 'desc', 'limit': 1}
+            ).json()
+            return r['_embedded']['records'][0]['paging_token']
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout,
+            KeyError,
+            IndexError,
+            ValueError
+        ) as e:
+            log.debug('Could not get the last transaction of {}: {}'.format(account, e))
+            return 'now'
+
+    def _stream(self, account, cursor):
+        """
+        Follows the transactions of `account` from `cursor`, and fetches its balances after each one. Reconnects from
+        the last transaction received when the stream ends, waiting longer after each stream without any transaction.
+        """
+        url = '{}/accounts/{}/transactions'.format(settings['stellar_exporter']['url'], account)
+        backoff = 1
+        while True:
+            try:
+                r = self.streamSession.get(
+                    url,
+                    params={'cursor': cursor},
+                    headers={'Accept': 'text/event-stream'},
+                    stream=True
+                )
+                r.raise_for_status()
+                r.encoding = 'utf-8'
+                with self.lock:
+                    self.connected.add(account)
+                for event_id, event, data in sse.events(r.iter_lines(chunk_size=None, decode_unicode=True)):
+                    if event != 'message' or event_id is None:
+                        continue
+                    log.debug('Transaction {} of {}'.format(event_id, account))
+                    cursor = event_id
+                    balances = self._getBalances(account)
+                    with self.lock:
+                        self.updates[account] = (balances, cursor)
+                    backoff = 1
+                log.debug('The stream of {} ended'.format(account))
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ReadTimeout,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.HTTPError
+            ) as e:
+                log.warning('The stream of {} failed: {}'.format(account, e))
+            except Exception:
+                log.exception('The stream of {} failed'.format(account))
+            with self.lock:
+                self.connected.discard(account)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, STREAM_MAX_BACKOFF)
+
+    def _startStreams(self, accounts):
+        accounts = [
+            account for account in accounts if account not in self.streams or not self.streams[account].is_alive()
+        ]
+        missing = [account for account in accounts if not self.cursors.get(account)]
+        for account, cursor in zip(missing, self.pool.map(self._getCursor, missing)):
+            self.cursors[account] = cursor
+        for account in accounts:
+            stream = threading.Thread(target=self._stream, args=(account, self.cursors[account]), daemon=True)
+            stream.start()
+            self.streams[account] = stream
+
+    def _refresh(self):
+        accounts = settings['stellar_exporter']['accounts']
+        if not settings['stellar_exporter']['stream']:
+            self._getAccounts(accounts)
+            return
+
+        self._startStreams(accounts)
+        with self.lock:
+            updates, self.updates = self.updates, {}
+            connected = set(self.connected)
+        for account, (balances, cursor) in updates.items():
+            self.cursors[account] = cursor
+            if balances is None:
+                self.stale.add(account)
+            else:
+                self.stale.discard(account)
+                self._setBalances(account, balances)
+        # Polled until their stream is up again
+        self.stale.update(account for account in accounts if account not in connected)
+        # The balances not updated by the streams haven't changed, unless they couldn't be fetched
+        loaded = set(self.accounts[key]['account'] for key in self.accounts)
+        self._getAccounts([account for account in accounts if account in self.stale or account not in loaded])
+        for key in self.accounts:
+            if self.accounts[key]['account'] in self.streams and self.accounts[key]['account'] not in self.stale:
+                self._seen('accounts', key)
+
+    def _collect(self):
         metrics = {
             'account_balance': GaugeMetricFamily(
                 'account_balance',
@@ -79,7 +245,6 @@ class StellarCollector:
                 labels=['source_currency', 'currency', 'account', 'type']
             ),
         }
-        self._getAccounts()
         for a in self.accounts:
             metrics['account_balance'].add_metric(
                 value=self.accounts[a]['balance'],
@@ -97,19 +262,23 @@ class StellarCollector:
 def _collect_to_text():
     e = StellarCollector()
     while True:
+        e.refresh()
         write_to_textfile('{0}/stellar_exporter.prom'.format(settings['stellar_exporter']['prom_folder']), e)
         time.sleep(int(settings['stellar_exporter']['interval']))
 
 
 def _collect_to_http():
-    REGISTRY.register(StellarCollector())
-    start_http_server(int(settings['stellar_exporter']['listen_port']))
-    while True:
-        time.sleep(int(settings['stellar_exporter']['interval']))
+    e = StellarCollector()
+    REGISTRY.register(e)
+    exposition = Exposition(REGISTRY)
+    start_http_server(int(settings['stellar_exporter']['listen_port']), exposition)
+    poller = Poller(e.refresh, int(settings['stellar_exporter']['interval']), exposition.render)
+    poller.start()
+    poller.join()
 
 
 if __name__ == '__main__':
-    settings()
+    _settings()
     log.debug('Loaded settings: {}'.format(settings))
     if settings['stellar_exporter']['export'] == 'text':
         _collect_to_text()
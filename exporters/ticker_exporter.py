@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import importlib
+import logging
+import time
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from prometheus_client import write_to_textfile
+from prometheus_client.core import REGISTRY, Metric
+from lib.collector import Collector
+from lib.exposition import Exposition, start_http_server
+from lib.poller import Poller
+from lib.settings import read_config, load_settings
+
+log = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=os.environ.get("LOGLEVEL", "INFO"))
+
+settings = {}
+
+# The exporters that can be hosted, with the name of their collector class
+EXPORTERS = {
+    'abucoins_exporter': 'AbucoinsCollector',
+    'binance_exporter': 'BinanceCollector',
+    'bitfinex_exporter': 'BitfinexCollector',
+    'bitstamp_exporter': 'BitstampCollector',
+    'cex_exporter': 'CexCollector',
+    'etherscan_exporter': 'EtherscanCollector',
+    'gdax_exporter': 'GdaxCollector',
+    'hitbtc_exporter': 'HitbtcCollector',
+    'kraken_exporter': 'KrakenCollector',
+    'poloniex_exporter': 'PoloniexCollector',
+    'qryptos_exporter': 'QryptosCollector',
+    'quoinex_exporter': 'QuoinexCollector',
+    'ripple_exporter': 'RippleCollector',
+    'stellar_exporter': 'StellarCollector',
+}
+
+
+def _settings(cfg=None):
+    global settings
+
+    if cfg is None:
+        cfg = read_config('/etc/ticker_exporter/ticker_exporter.yaml')
+    settings = {
+        'ticker_exporter': load_settings({
+            'prom_folder': '/var/lib/node_exporter',
+            'interval': 60,
+            'export': 'text',
+            'listen_port': 9298,
+            'workers': 4,
+            'engine': 'threads',
+            'connections': 100,
+        }, cfg.get('ticker_exporter')),
+    }
+
+
+class TickerCollector(Collector):
+    """
+    Hosts the collectors of all the exporters configured in the `ticker_exporter.yaml`, and refreshes them
+    concurrently.
+    """
+
+    def __init__(self, cfg):
+        super().__init__()
+        self.collectors = {}
+        for exporter in EXPORTERS:
+            if exporter not in cfg:
+                continue
+            log.info('Loading {}'.format(exporter))
+            module = importlib.import_module(exporter)
+            module._settings(cfg)
+            self.collectors[exporter] = getattr(module, EXPORTERS[exporter])()
+        self.pool = ThreadPoolExecutor(max_workers=int(settings['ticker_exporter']['workers']))
+        self.engine = None
+        if settings['ticker_exporter']['engine'] == 'async':
+            from lib.async_engine import AsyncEngine
+            self.engine = AsyncEngine(self.collectors, self.pool, int(settings['ticker_exporter']['connections']))
+        # Serve the restored snapshots until the first refresh
+        self.publish()
+
+    def _refresh(self):
+        if self.engine:
+            self.engine.refresh()
+            return
+        futures = {
+            self.pool.submit(collector.refresh): exporter for exporter, collector in self.collectors.items()
+        }
+        for future in as_completed(futures):
+            if future.exception():
+                log.warning('Could not refresh {}: {}'.format(futures[future], future.exception()))
+
+    def _collect(self):
+        """
+        Merges the metric families with the same name, since a name can only be exported once.
+        """
+        metrics = {}
+        for collector in self.collectors.values():
+            for m in collector.collect():
+                if m.name not in metrics:
+                    metrics[m.name] = Metric(m.name, m.documentation, m.type)
+                metrics[m.name].samples.extend(m.samples)
+
+        for m in metrics.values():
+            yield m
+
+
+def _collect_to_text(cfg):
+    e = TickerCollector(cfg)
+    while True:
+        e.refresh()
+        write_to_textfile('{0}/ticker_exporter.prom'.format(settings['ticker_exporter']['prom_folder']), e)
+        time.sleep(int(settings['ticker_exporter']['interval']))
+
+
+def _collect_to_http(cfg):
+    e = TickerCollector(cfg)
+    REGISTRY.register(e)
+    exposition = Exposition(REGISTRY)
+    start_http_server(int(settings['ticker_exporter']['listen_port']), exposition)
+    poller = Poller(e.refresh, int(settings['ticker_exporter']['interval']), exposition.render)
+    poller.start()
+    poller.join()
+
+
+if __name__ == '__main__':
+    cfg = read_config('/etc/ticker_exporter/ticker_exporter.yaml')
+    _settings(cfg)
+    log.debug('Loaded settings: {}'.format(settings))
+    if settings['ticker_exporter']['export'] == 'text':
+        _collect_to_text(cfg)
+    if settings['ticker_exporter']['export'] == 'http':
+        _collect_to_http(cfg)